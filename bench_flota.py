@@ -0,0 +1,505 @@
+"""
+Banco de pruebas de carga para server_tcp.py con una flota simulada.
+
+Emula en localhost el protocolo de Etiqueta.cpp (PING->PONG EMPTY/DATA,
+SET->ACK, SELL->SOLD/RESET) y de los lectores NFC-Caja/NFC-Puerta
+(ROLE, SCAN, READUID->UID), con latencia, jitter y pérdida configurables.
+
+Arranca el servidor sin menú en un directorio temporal (los CSV no tocan
+los reales), lanza escaneos desde los lectores simulados y al final
+informa de percentiles de latencia de escaneo, tasa de PONGs completados,
+CPU y memoria del proceso servidor.
+
+Ejemplo:
+    python bench_flota.py --etiquetas 2000 --lectores 4 --duracion 30 \\
+        --latencia-ms 20 --jitter-ms 30 --perdida 0.01 --json resultado.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from collections import deque
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server_tcp.py")
+
+TIPOS = ("Camiseta", "Pantalón", "Gorra", "Chaqueta", "Vestido", "Zapatos")
+TEMPORADAS = ("Verano", "Invierno", "Primavera", "Otoño")
+
+CONNECT_PARALLEL = 200   # conexiones abiertas a la vez al montar la flota
+SCAN_REPLY_TIMEOUT_S = 15.0
+REPLY_PREFIXES = ("PAY ", "DOOR ", "BUSY ")
+# SCAN_DEDUPE_WINDOW_S de server_tcp.py (+ margen): un lector no repite UID
+# dentro de esta ventana, para medir escaneos reales y no aciertos de caché.
+DEDUPE_WINDOW_S = 3.5
+
+
+# ------------------ Utilidades ------------------
+
+def percentiles(samples, qs=(0.50, 0.90, 0.99)):
+    if not samples:
+        return {}
+    s = sorted(samples)
+    out = {f"p{int(q * 100)}_ms": round(s[min(len(s) - 1, int(q * len(s)))] * 1000, 2) for q in qs}
+    out["max_ms"] = round(s[-1] * 1000, 2)
+    out["avg_ms"] = round(sum(s) / len(s) * 1000, 2)
+    return out
+
+
+def raise_nofile_limit():
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or hard > soft:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except Exception:
+        pass
+
+
+def free_port() -> int:
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+# ------------------ Proceso servidor (/proc) ------------------
+
+def proc_cpu_seconds(pid: int) -> float:
+    with open(f"/proc/{pid}/stat") as f:
+        # el nombre del proceso va entre paréntesis y puede tener espacios
+        fields = f.read().rsplit(")", 1)[1].split()
+    utime, stime = int(fields[11]), int(fields[12])
+    return (utime + stime) / os.sysconf("SC_CLK_TCK")
+
+
+def proc_memory_kb(pid: int) -> dict:
+    out = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith(("VmRSS:", "VmHWM:", "Threads:")):
+                k, v = line.split(":", 1)
+                out[k] = int(v.split()[0])
+    return out
+
+
+def start_server(port: int, metrics_port: int, workdir: str) -> subprocess.Popen:
+    proc = subprocess.Popen(
+        [sys.executable, SERVER_SCRIPT, "--sin-menu", "--port", str(port), "--metrics-port", str(metrics_port)],
+        cwd=workdir, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"el servidor terminó al arrancar (código {proc.returncode})")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("el servidor no abrió el puerto a tiempo")
+
+
+def stop_server(proc: subprocess.Popen):
+    proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def fetch_metrics(metrics_port: int):
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics.json", timeout=5) as r:
+            return json.loads(r.read().decode("utf-8"))
+    except Exception:
+        return None
+
+
+# ------------------ Dispositivos simulados ------------------
+
+class SimConfig:
+    def __init__(self, args):
+        self.latency_s = args.latencia_ms / 1000.0
+        self.jitter_s = args.jitter_ms / 1000.0
+        self.drop = args.perdida
+
+    def delay(self) -> float:
+        return self.latency_s + random.uniform(0, self.jitter_s)
+
+
+class SimTag:
+    """Etiqueta ESP32: responde de una en una, como el loop() del firmware."""
+
+    def __init__(self, cfg: SimConfig, data=None):
+        self.cfg = cfg
+        self.data = data  # None = vacía
+        self.writer = None
+        self.pings = 0
+        self.pongs = 0
+        self.dropped = 0
+
+    def send(self, line: str):
+        self.writer.write((line + "\n").encode("utf-8"))
+
+    def _payload(self, with_location: bool) -> str:
+        d = self.data
+        out = {"ID": d["ID"], "Temporada": d["Temporada"], "Tipo": d["Tipo"]}
+        if with_location:
+            out["Ubicacion"] = d["Ubicacion"]
+        out["Precio"] = d["Precio"]
+        if with_location:
+            out["UID"] = d["UID"]
+        return json.dumps(out, ensure_ascii=False)
+
+    async def connect(self, host: str, port: int):
+        reader, self.writer = await asyncio.open_connection(host, port)
+        return reader
+
+    async def listen(self, reader):
+        try:
+            while True:
+                raw = await reader.readline()
+                if not raw:
+                    return
+                await self.handle(raw.decode("utf-8", errors="replace").strip())
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    async def handle(self, line: str):
+        if line.startswith("PING "):
+            self.pings += 1
+            if random.random() < self.cfg.drop:
+                self.dropped += 1
+                return
+            await asyncio.sleep(self.cfg.delay())
+            rid = line[5:].strip()
+            if self.data is None:
+                self.send(f"PONG {rid} EMPTY")
+            else:
+                self.send(f"PONG {rid} DATA " + self._payload(True))
+            self.pongs += 1
+        elif line.startswith("SET "):
+            await asyncio.sleep(self.cfg.delay())
+            try:
+                self.data = json.loads(line[4:])
+                self.send(f"ACK ID={self.data['ID']}")
+            except (ValueError, KeyError):
+                self.send("NACK")
+        elif line == "SELL":
+            await asyncio.sleep(self.cfg.delay())
+            if self.data is None:
+                self.send("SELL_DENIED EMPTY")
+            elif self.data.get("Ubicacion") == "Tienda":
+                self.send("SOLD " + self._payload(False))
+                self.data = None
+                self.send("RESET OK AFTER_SALE")
+            else:
+                self.send(f"SELL_DENIED UBI={self.data.get('Ubicacion')}")
+
+
+class SimReader:
+    """Lector NFC (BOX = caja, DOOR = puerta): lanza SCAN y mide hasta la respuesta."""
+
+    def __init__(self, role: str):
+        self.role = role
+        self.writer = None
+        self.replies = asyncio.Queue()
+        self.latencies = []
+        self.outcomes = {}
+        self.timeouts = 0
+        self.waits = 0           # veces sin UID disponible fuera de la ventana
+        self._recent = set()     # UIDs escaneados dentro de DEDUPE_WINDOW_S
+        self._recent_q = deque() # (instante, UID) para caducarlos en orden
+
+    def is_recent(self, uid_hex: str, now: float) -> bool:
+        while self._recent_q and now - self._recent_q[0][0] > DEDUPE_WINDOW_S:
+            self._recent.discard(self._recent_q.popleft()[1])
+        return uid_hex in self._recent
+
+    def remember(self, uid_hex: str, now: float):
+        self._recent.add(uid_hex)
+        self._recent_q.append((now, uid_hex))
+
+    def send(self, line: str):
+        self.writer.write((line + "\n").encode("utf-8"))
+
+    async def connect(self, host: str, port: int):
+        reader, self.writer = await asyncio.open_connection(host, port)
+        self.send(f"ROLE NFC {self.role}")
+        return reader
+
+    async def listen(self, reader):
+        try:
+            while True:
+                raw = await reader.readline()
+                if not raw:
+                    return
+                line = raw.decode("utf-8", errors="replace").strip()
+                if line.startswith("PING "):
+                    self.send(f"PONG {line[5:].strip()} NFC {self.role}")
+                elif line.startswith("READUID "):
+                    self.send(f"UID {line[8:].strip()} {random.getrandbits(56):014X}")
+                elif line.startswith(REPLY_PREFIXES):
+                    self.replies.put_nowait((time.perf_counter(), line))
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    async def scan(self, uid_hex: str):
+        t0 = time.perf_counter()
+        self.send(f"SCAN {uid_hex}")
+        try:
+            t1, line = await asyncio.wait_for(self.replies.get(), SCAN_REPLY_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return
+        self.latencies.append(t1 - t0)
+        parts = line.split()
+        outcome = parts[0] if parts[0] == "BUSY" else f"{parts[0]} {parts[1]}"
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+
+# ------------------ Escenario ------------------
+
+def build_fleet(cfg: SimConfig, args):
+    tags = []
+    for i in range(1, args.etiquetas + 1):
+        if random.random() < args.vacias:
+            tags.append(SimTag(cfg))
+            continue
+        tags.append(SimTag(cfg, {
+            "ID": i,
+            "Temporada": random.choice(TEMPORADAS),
+            "Tipo": random.choice(TIPOS),
+            "Ubicacion": random.choice(("Almacén", "Tienda")),
+            "Precio": round(random.uniform(5, 120), 2),
+            "UID": f"04{i:012X}",
+        }))
+    return tags
+
+
+def pick_uid(reader: SimReader, tags, unknown_ratio: float):
+    """UID a escanear que este lector no haya usado en DEDUPE_WINDOW_S (None si no hay)."""
+    if random.random() < unknown_ratio:
+        return f"FF{random.getrandbits(48):012X}"
+    now = time.perf_counter()
+    for _ in range(20):
+        t = random.choice(tags)
+        if t.data is not None and not reader.is_recent(t.data["UID"], now):
+            return t.data["UID"]
+    return None
+
+
+async def scan_loop(reader: SimReader, tags, args, stop_at: float):
+    while time.perf_counter() < stop_at:
+        uid_hex = pick_uid(reader, tags, args.desconocidos)
+        if uid_hex is None:
+            # Flota pequeña para el ritmo pedido: esperar a que caduque algún UID
+            reader.waits += 1
+            await asyncio.sleep(0.05)
+            continue
+        reader.remember(uid_hex, time.perf_counter())
+        await reader.scan(uid_hex)
+        if args.pausa_ms:
+            await asyncio.sleep(args.pausa_ms / 1000.0)
+
+
+async def run_bench(args, host: str, port: int, pid, metrics_port: int):
+    cfg = SimConfig(args)
+    tags = build_fleet(cfg, args)
+    tasks = []
+
+    t_conn = time.perf_counter()
+    sem = asyncio.Semaphore(CONNECT_PARALLEL)
+
+    async def start_tag(t):
+        async with sem:
+            reader = await t.connect(host, port)
+        await t.listen(reader)
+
+    tasks += [asyncio.create_task(start_tag(t)) for t in tags]
+    while sum(1 for t in tags if t.writer is not None) < len(tags):
+        await asyncio.sleep(0.05)
+    connect_s = time.perf_counter() - t_conn
+
+    readers = [SimReader("BOX") for _ in range(args.lectores)] + \
+              [SimReader("DOOR") for _ in range(args.lectores)]
+    for r in readers:
+        tasks.append(asyncio.create_task(r.listen(await r.connect(host, port))))
+
+    await asyncio.sleep(args.calentamiento)
+
+    cpu0 = proc_cpu_seconds(pid) if pid else None
+    wall0 = time.perf_counter()
+    stop_at = wall0 + args.duracion
+    await asyncio.gather(*(scan_loop(r, tags, args, stop_at) for r in readers))
+    wall = time.perf_counter() - wall0
+    cpu1 = proc_cpu_seconds(pid) if pid else None
+    mem = proc_memory_kb(pid) if pid else {}
+
+    loop = asyncio.get_running_loop()
+    server_metrics = await loop.run_in_executor(None, fetch_metrics, metrics_port) if metrics_port else None
+
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    return summarize(args, tags, readers, connect_s, wall, cpu0, cpu1, mem, server_metrics)
+
+
+def summarize(args, tags, readers, connect_s, wall, cpu0, cpu1, mem, server_metrics):
+    result = {
+        "config": {
+            "etiquetas": args.etiquetas, "vacias": args.vacias, "lectores_por_rol": args.lectores,
+            "latencia_ms": args.latencia_ms, "jitter_ms": args.jitter_ms, "perdida": args.perdida,
+            "desconocidos": args.desconocidos, "duracion_s": args.duracion,
+        },
+        "conexion_flota_s": round(connect_s, 2),
+        "scans": {},
+    }
+
+    total = 0
+    for role in ("BOX", "DOOR"):
+        rs = [r for r in readers if r.role == role]
+        lat = [x for r in rs for x in r.latencies]
+        outcomes = {}
+        for r in rs:
+            for k, v in r.outcomes.items():
+                outcomes[k] = outcomes.get(k, 0) + v
+        total += len(lat)
+        result["scans"][role] = {
+            "n": len(lat),
+            "timeouts": sum(r.timeouts for r in rs),
+            "por_segundo": round(len(lat) / wall, 2) if wall else 0,
+            "latencia": percentiles(lat),
+            "resultados": dict(sorted(outcomes.items())),
+            "esperas_sin_uid": sum(r.waits for r in rs),
+        }
+    result["scans_por_segundo"] = round(total / wall, 2) if wall else 0
+
+    pings = sum(t.pings for t in tags)
+    result["flota"] = {
+        "pings_recibidos": pings,
+        "pongs_enviados": sum(t.pongs for t in tags),
+        "pongs_perdidos_simulados": sum(t.dropped for t in tags),
+    }
+
+    if cpu0 is not None:
+        result["servidor"] = {
+            "cpu_pct": round((cpu1 - cpu0) / wall * 100, 1) if wall else 0,
+            "rss_mb": round(mem.get("VmRSS", 0) / 1024, 1),
+            "rss_pico_mb": round(mem.get("VmHWM", 0) / 1024, 1),
+            "hilos": mem.get("Threads"),
+        }
+
+    if server_metrics:
+        counters = server_metrics.get("counters", {})
+        expected = counters.get("pong.expected", 0)
+        missed = counters.get("pong.missed", 0)
+        # Con la ventana respetada deberían ser 0: si no, la latencia mide la caché
+        result["scans_dedupe_hits"] = counters.get("scan.dedupe_hits", 0)
+        result["sondeos"] = {
+            "polls": counters.get("poll.calls", 0),
+            "coalescidos": counters.get("poll.coalesced", 0),
+            "pongs_esperados": expected,
+            "pongs_faltantes": missed,
+            "completado_pct": round((expected - missed) / expected * 100, 2) if expected else None,
+        }
+        result["metricas_servidor"] = server_metrics.get("latency", {})
+    return result
+
+
+def print_report(res: dict):
+    cfg = res["config"]
+    print(f"\n=== Flota: {cfg['etiquetas']} etiquetas, {cfg['lectores_por_rol']} lectores por rol, "
+          f"{cfg['duracion_s']}s ===")
+    print(f"Conexión de la flota: {res['conexion_flota_s']}s")
+    print(f"Escaneos/s totales: {res['scans_por_segundo']}")
+    if "scans_dedupe_hits" in res:
+        print(f"Respondidos desde la caché antirrebote (no son escaneos reales): {res['scans_dedupe_hits']}")
+    for role, s in res["scans"].items():
+        lat = s["latencia"]
+        print(f"  {role:<5} n={s['n']:<6} {s['por_segundo']:>8}/s  timeouts={s['timeouts']}  "
+              f"p50={lat.get('p50_ms', '-')}ms p90={lat.get('p90_ms', '-')}ms "
+              f"p99={lat.get('p99_ms', '-')}ms max={lat.get('max_ms', '-')}ms")
+        for k, v in s["resultados"].items():
+            print(f"        {k}: {v}")
+        if s["esperas_sin_uid"]:
+            print(f"        esperas sin UID libre: {s['esperas_sin_uid']} (flota pequeña para este ritmo)")
+    if "sondeos" in res:
+        p = res["sondeos"]
+        print(f"Sondeos: {p['polls']} ({p['coalescidos']} coalescidos), PONGs completados "
+              f"{p['completado_pct']}% ({p['pongs_faltantes']} de {p['pongs_esperados']} sin respuesta)")
+    f = res["flota"]
+    print(f"Flota: {f['pings_recibidos']} PING, {f['pongs_enviados']} PONG, "
+          f"{f['pongs_perdidos_simulados']} perdidos a propósito")
+    if "servidor" in res:
+        sv = res["servidor"]
+        print(f"Servidor: CPU {sv['cpu_pct']}%  RSS {sv['rss_mb']} MB (pico {sv['rss_pico_mb']} MB)  "
+              f"hilos {sv['hilos']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de server_tcp.py con una flota simulada")
+    parser.add_argument("--etiquetas", type=int, default=500, help="etiquetas simuladas (por defecto 500)")
+    parser.add_argument("--vacias", type=float, default=0.1, help="fracción de etiquetas vacías (por defecto 0.1)")
+    parser.add_argument("--lectores", type=int, default=2, help="lectores por rol, BOX y DOOR (por defecto 2)")
+    parser.add_argument("--duracion", type=float, default=20.0, help="segundos de escaneos (por defecto 20)")
+    parser.add_argument("--calentamiento", type=float, default=1.0, help="espera antes de medir (por defecto 1s)")
+    parser.add_argument("--latencia-ms", type=float, default=5.0, help="latencia de respuesta de las etiquetas")
+    parser.add_argument("--jitter-ms", type=float, default=10.0, help="jitter uniforme añadido a la latencia")
+    parser.add_argument("--perdida", type=float, default=0.0, help="probabilidad de no contestar un PING")
+    parser.add_argument("--desconocidos", type=float, default=0.05,
+                        help="fracción de escaneos con UID inexistente (fuerzan broadcast)")
+    parser.add_argument("--pausa-ms", type=float, default=0.0, help="pausa de cada lector entre escaneos")
+    parser.add_argument("--externo", metavar="HOST:PUERTO",
+                        help="medir un servidor ya arrancado en vez de lanzar uno (sin CPU/RSS salvo --pid)")
+    parser.add_argument("--pid", type=int, help="PID del servidor externo para medir CPU/RSS")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="puerto de métricas del servidor externo (0 = no consultarlas)")
+    parser.add_argument("--semilla", type=int, help="semilla aleatoria para repetir el escenario")
+    parser.add_argument("--json", metavar="FICHERO", help="guardar el resultado en JSON")
+    args = parser.parse_args()
+
+    if args.semilla is not None:
+        random.seed(args.semilla)
+    raise_nofile_limit()
+
+    proc = None
+    workdir = None
+    if args.externo:
+        host, _, port = args.externo.rpartition(":")
+        port = int(port)
+        pid, metrics_port = args.pid, args.metrics_port
+    else:
+        workdir = tempfile.TemporaryDirectory(prefix="bench_flota_")
+        host, port, metrics_port = "127.0.0.1", free_port(), free_port()
+        proc = start_server(port, metrics_port, workdir.name)
+        pid = proc.pid
+
+    try:
+        res = asyncio.run(run_bench(args, host, port, pid, metrics_port))
+    finally:
+        if proc is not None:
+            stop_server(proc)
+        if workdir is not None:
+            workdir.cleanup()
+
+    print_report(res)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(res, f, ensure_ascii=False, indent=2)
+        print(f"\nResultado guardado en {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,80 @@
 import socket
+import selectors
 import threading
 import json
 import time
 import os
 import re
 import csv
+import sqlite3
+import argparse
+import hashlib
+import io
+import queue
+import atexit
+import itertools
+import heapq
+import logging
+import logging.handlers
+import bisect
+import random
+import signal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import OrderedDict, deque
+from concurrent.futures import Future
 from datetime import datetime
 
+try:
+    import orjson  # opcional: decodificar los PONG DATA es lo más caro de cada poll
+except ImportError:
+    orjson = None
+
 HOST = "0.0.0.0"
 PORT = 5000
-
-clients_lock = threading.Lock()
-clients = {}  # cid -> dict(conn, addr, configured, last_seen, buffer, tag_data)
-
-next_id_lock = threading.Lock()
-next_tag_id = 1
-
-# Para recopilar respuestas al PING (rid -> {cid: payload})
-ping_lock = threading.Lock()
-ping_cv = threading.Condition(ping_lock)
-ping_responses = {}  # rid -> dict(cid -> dict(status, data, raw))
-
-# Para esperar ACK de SET (cid -> {"id": int, "ok": bool, "ts": float})
-ack_lock = threading.Lock()
-ack_cv = threading.Condition(ack_lock)
-ack_responses = {}  # cid -> last_ack_id
-
-# Espera UID desde lector NFC (rid -> {"cid":int, "uid":str, "role":str})
-uid_lock = threading.Lock()
-uid_cv = threading.Condition(uid_lock)
-uid_responses = {}  # rid -> dict
+LISTEN_BACKLOG = 1024
+RECV_SIZE = 16384      # bytes por recv (un burst de PONGs cabe en una lectura)
+MAX_LINE_BYTES = 8192  # una línea más larga sin '\n' => cliente abusivo, se desconecta
+OUT_HIGH_WATER = 64 * 1024   # salida pendiente a partir de la cual el cliente se marca lento
+OUT_LOW_WATER = 8 * 1024     # por debajo de esto deja de considerarse lento
+OUT_MAX_BYTES = 1024 * 1024  # salida pendiente máxima: se desconecta al cliente
+
+# Vivacidad: sondeo a los clientes callados y expulsión de los muertos
+IDLE_PROBE_S = 60.0      # sin recibir nada en este tiempo => se le manda un PING de sondeo
+PROBE_SUSPECT_S = 3.0    # sondeo sin respuesta en este tiempo => fuera de los polls
+PROBE_TIMEOUT_S = 15.0   # sondeo sin respuesta en este tiempo => se desconecta
+PROBE_RID_PREFIX = "S"   # rid de los PING de sondeo: su PONG no tiene espera registrada
+KEEPALIVE_IDLE_S = 60    # TCP keepalive (además del sondeo a nivel de protocolo)
+KEEPALIVE_INTVL_S = 10
+KEEPALIVE_CNT = 3
+
+selector = selectors.DefaultSelector()
+
+# Respuestas correlacionadas (ver Correlator más abajo):
+#   ("PING", rid) -> {cid: dict(status, tag)}  (tag: TagRecord o None)
+#   ("ACK", cid)  -> {cid: ack_id}
+#   ("UID", rid)  -> {cid: hexuid}
+WAITER_GRACE_S = 5.0       # margen extra antes de dar por abandonada una espera
+WAITER_SWEEP_EVERY_S = 30.0
+
+# Índice en vivo de etiquetas (y caché de stock): se alimenta de PONG,
+# SET/ACK, MOVE y SOLD. tag None = la etiqueta estaba VACÍA; ts = última
+# vez que se supo de ella, para mostrar la antigüedad de cada entrada.
+tags_lock = threading.Lock()
+tag_index = {}     # cid -> {"tag": TagRecord | None, "ts": float}
+uid_index = {}     # UID -> cid
+pending_sets = {}  # cid -> (TagRecord enviado en el último SET, monotonic del envío)
+reserved_tags = set()  # cids VACÍOS apartados por una alta masiva en curso
+quarantined_tags = set()  # cids abandonados por una alta masiva: sus datos no se indexan hasta que se desconecten
+tag_index_version = 0  # sube con cada cambio del índice (para no guardar el registro sin cambios)
+
+# Single-flight: polls que llegan mientras hay un broadcast reciente se suman a él
+COALESCE_WINDOW_S = 0.3
+flight_lock = threading.Lock()
+current_flight = None  # dict(rid, waiter, snapshot, expected, started, users, judged, missed)
+_rid_seq = itertools.count(int(time.time() * 1000))
+
+VERIFY_TIMEOUT_S = 1.0  # PING dirigido para confirmar una entrada del índice
+MAX_EMPTY_LISTED = 20   # alta: basta con las primeras VACÍAS que respondan
 
 
 # ------------------ Utilidades ------------------
@@ -37,6 +82,18 @@ uid_responses = {}  # rid -> dict
 def now_ts():
     return time.strftime("%H:%M:%S")
 
+if orjson is not None:
+    def json_loads(s):
+        return orjson.loads(s)
+
+    def json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+else:
+    json_loads = json.loads
+
+    def json_dumps(obj) -> str:
+        return json.dumps(obj, ensure_ascii=False)
+
 def now_iso():
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
@@ -46,31 +103,906 @@ def c(txt, code):
 def clear():
     os.system("cls" if os.name == "nt" else "clear")
 
-def send_line(conn: socket.socket, text: str):
-    conn.sendall((text + "\n").encode("utf-8", errors="ignore"))
+
+# ------------------ Logging ------------------
+
+# Los hilos de red y de escaneo solo encolan el registro; un único hilo
+# (QueueListener) escribe en consola y en el fichero rotativo. Si la cola se
+# llena el registro se descarta antes que bloquear a quien lo emite.
+LOG_FILE = "servidor.log"
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 5
+LOG_QUEUE_MAX = 10000
+LOG_FILE_LEVEL = "DEBUG"
+LOG_CONSOLE_LEVEL = "WARNING"  # la consola es del menú: solo avisos
+# Traza por línea recibida (DEBUG): se registra 1 de cada N por comando
+LOG_SAMPLE = {"PONG": 1000, "ACK": 10}
+
+log = logging.getLogger("zarastock")
+_log_listener = None
+_log_sample_counts = {}
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _LogFormatter(logging.Formatter):
+    """Mismo aspecto que los print de siempre: [HH:MM:SS] y [!] en avisos y errores."""
+
+    def format(self, record):
+        text = super().format(record)
+        if record.levelno >= logging.WARNING:
+            return f"[{self.formatTime(record, '%H:%M:%S')}] [!] {text}"
+        return f"[{self.formatTime(record, '%H:%M:%S')}] {text}"
+
+
+def setup_logging(log_file: str = LOG_FILE, file_level: str = LOG_FILE_LEVEL,
+                  console_level: str = LOG_CONSOLE_LEVEL):
+    global _log_listener
+
+    handlers = []
+    console = logging.StreamHandler()
+    console.setLevel(console_level)
+    console.setFormatter(_LogFormatter())
+    handlers.append(console)
+    if log_file:
+        rotating = logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding="utf-8")
+        rotating.setLevel(file_level)
+        rotating.setFormatter(_LogFormatter())
+        handlers.append(rotating)
+
+    q = queue.Queue(LOG_QUEUE_MAX)
+    qh = _DroppingQueueHandler(q)
+    log.handlers[:] = [qh]
+    log.setLevel(min(h.level for h in handlers))
+    log.propagate = False
+
+    _log_listener = logging.handlers.QueueListener(q, *handlers, respect_handler_level=True)
+    _log_listener.start()
+    metrics.gauge("log.queue", q.qsize)
+    metrics.gauge("log.dropped", lambda: qh.dropped)
+
+
+def stop_logging():
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()  # vacía lo que quede en la cola
+        _log_listener = None
+
+
+def log_line_sampled(cmd: str) -> bool:
+    """True para 1 de cada LOG_SAMPLE[cmd] líneas. Solo lo llama el hilo del bucle."""
+    every = LOG_SAMPLE.get(cmd, 1)
+    if every <= 1:
+        return True
+    n = _log_sample_counts.get(cmd, 0)
+    _log_sample_counts[cmd] = n + 1
+    return n % every == 0
+
+
+# ------------------ Métricas ------------------
+
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 5001  # GET /metrics (texto) o /metrics.json; 0 = desactivado
+
+# Límites superiores (segundos) de los cubos de los histogramas de latencia
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+RATE_WINDOW_S = 60
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "total", "min", "max")
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def observe(self, v: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, v)] += 1
+        self.count += 1
+        self.total += v
+        if v < self.min:
+            self.min = v
+        if v > self.max:
+            self.max = v
+
+    def quantile(self, q: float) -> float:
+        """Aproximación por cubos: límite superior del cubo que contiene el cuantil."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        acc = 0
+        for bound, n in zip(LATENCY_BUCKETS, self.counts):
+            acc += n
+            if acc >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count * 1000, 3),
+            "min_ms": round(self.min * 1000, 3),
+            "p50_ms": round(self.quantile(0.50) * 1000, 3),
+            "p90_ms": round(self.quantile(0.90) * 1000, 3),
+            "p99_ms": round(self.quantile(0.99) * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+        }
+
+
+class Rate:
+    """Eventos por segundo en una ventana deslizante (anillo de cubos de 1 s)."""
+
+    __slots__ = ("secs", "counts")
+
+    def __init__(self):
+        self.secs = [0] * RATE_WINDOW_S
+        self.counts = [0] * RATE_WINDOW_S
+
+    def add(self, n: int, now: float):
+        sec = int(now)
+        i = sec % RATE_WINDOW_S
+        if self.secs[i] != sec:
+            self.secs[i] = sec
+            self.counts[i] = 0
+        self.counts[i] += n
+
+    def per_second(self, window_s: int, now: float) -> float:
+        sec = int(now)
+        # el segundo en curso está incompleto: se cuenta la ventana anterior
+        total = sum(c for s_, c in zip(self.secs, self.counts) if sec - window_s <= s_ < sec)
+        return total / window_s
+
+
+class Metrics:
+    """
+    Contadores, tasas, histogramas de latencia y gauges (funciones que se
+    evalúan al consultar). Todo en memoria; se consulta desde el menú o por
+    el endpoint HTTP local.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._rates = {}
+        self._hists = {}
+        self._gauges = {}
+        self.started = time.time()
+
+    def inc(self, name: str, n: int = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def mark(self, name: str, n: int = 1):
+        """Contador con tasa por segundo."""
+        now = time.time()
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+            r = self._rates.get(name)
+            if r is None:
+                r = self._rates[name] = Rate()
+            r.add(n, now)
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            h = self._hists.get(name)
+            if h is None:
+                h = self._hists[name] = Histogram()
+            h.observe(seconds)
+
+    def gauge(self, name: str, fn):
+        self._gauges[name] = fn
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        with self._lock:
+            out = {
+                "uptime_s": round(now - self.started, 1),
+                "counters": dict(sorted(self._counters.items())),
+                "rates": {k: {"1s": r.per_second(1, now), "10s": round(r.per_second(10, now), 2),
+                              "60s": round(r.per_second(60, now), 2)}
+                          for k, r in sorted(self._rates.items())},
+                "latency": {k: h.summary() for k, h in sorted(self._hists.items())},
+            }
+        gauges = {}
+        for k, fn in sorted(self._gauges.items()):
+            try:
+                gauges[k] = fn()
+            except Exception:
+                gauges[k] = None
+        out["gauges"] = gauges
+        return out
+
+    def render_text(self) -> str:
+        snap = self.snapshot()
+        lines = [f"uptime_s {snap['uptime_s']}"]
+        for k, v in snap["gauges"].items():
+            lines.append(f"gauge {k} {v}")
+        for k, v in snap["counters"].items():
+            lines.append(f"counter {k} {v}")
+        for k, r in snap["rates"].items():
+            lines.append(f"rate {k} 1s={r['1s']} 10s={r['10s']} 60s={r['60s']}")
+        for k, h in snap["latency"].items():
+            lines.append(f"latency {k} " + " ".join(f"{kk}={vv}" for kk, vv in h.items()))
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith("/metrics.json"):
+            body = json.dumps(metrics.snapshot(), ensure_ascii=False).encode("utf-8")
+            ctype = "application/json; charset=utf-8"
+        elif self.path.startswith("/metrics"):
+            body = metrics.render_text().encode("utf-8")
+            ctype = "text/plain; charset=utf-8"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # no ensuciar la consola del menú
+
+
+def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT):
+    try:
+        httpd = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        log.warning(f"No se pudo abrir el endpoint de métricas en {host}:{port}: {e}")
+        return None
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    print(f"[{now_ts()}] Métricas en http://{host}:{port}/metrics (y /metrics.json)")
+    return httpd
 
 
 # ------------------ CSV Logging ------------------
 
 MOV_CSV = "movimientos.csv"
 VEN_CSV = "ventas.csv"
+MOV_HEADERS = ["timestamp", "ip", "id", "temporada", "tipo", "from", "to", "precio", "uid"]
+VEN_HEADERS = ["timestamp", "ip", "id", "temporada", "tipo", "precio", "uid"]
+
+CSV_QUEUE_MAX = 10000        # filas en espera antes de rechazar (back-pressure)
+CSV_BATCH_ROWS = 256         # group commit: volcar cada N filas...
+CSV_FLUSH_INTERVAL_S = 0.5   # ...o cada X segundos, lo que llegue antes
+CSV_FSYNC = False            # fsync tras cada volcado (más lento, más seguro)
+TAIL_BLOCK_BYTES = 64 * 1024 # lectura desde el final en bloques (se duplica si no basta)
+
+
+class CsvWriter:
+    """
+    Escritor de CSV en segundo plano. Mantiene los ficheros abiertos, agrupa
+    las filas y las vuelca por tamaño o por tiempo, de modo que los hilos de
+    red nunca tocan el disco.
+
+    submit() nunca bloquea: lo llama el bucle de eventos. Con la cola llena
+    las filas normales se rechazan (back-pressure), pero las del libro de
+    ventas (durable=True) entran igualmente por encima del límite, en la
+    misma cola y en orden: una venta nunca se pierde ni se adelanta.
+    """
+
+    def __init__(self, max_queue=CSV_QUEUE_MAX, batch_rows=CSV_BATCH_ROWS,
+                 flush_interval_s=CSV_FLUSH_INTERVAL_S, fsync=CSV_FSYNC):
+        self._q = queue.Queue()  # sin maxsize: el límite lo aplica submit()
+        self._max_queue = max_queue
+        self._batch_rows = batch_rows
+        self._flush_interval_s = flush_interval_s
+        self._fsync = fsync
+        self._files = {}  # filename -> (file, DictWriter)
+        self._listeners = {}  # filename -> [(on_row, on_flush)]
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.dropped = 0
+
+    def _ensure_started(self):
+        if self._thread:
+            return
+        with self._start_lock:
+            if not self._thread:
+                t = threading.Thread(target=self._run, daemon=True)
+                t.start()
+                self._thread = t
+
+    def submit(self, filename: str, headers: list[str], row: dict, durable: bool = False) -> bool:
+        """Encola una fila sin esperar. Devuelve False si la cola está llena (nunca con durable=True)."""
+        self._ensure_started()
+        if self._q.qsize() >= self._max_queue:
+            if not durable:
+                self.dropped += 1
+                metrics.inc("csv.rejected")
+                return False
+            metrics.inc("csv.overflow")
+        self._q.put_nowait((filename, headers, row))
+        return True
+
+    def subscribe(self, filename: str, on_row=None, on_flush=None):
+        """
+        on_row(row) se llama tras escribir cada fila de `filename`;
+        on_flush(filename, offset) tras cada volcado, con el tamaño ya en disco.
+        Ambos corren en el hilo escritor.
+        """
+        self._listeners.setdefault(filename, []).append((on_row, on_flush))
+
+    def call(self, fn) -> bool:
+        """Ejecuta fn() en el hilo escritor, tras volcar todo lo encolado antes."""
+        self._ensure_started()
+        self._q.put_nowait(fn)
+        return True
+
+    def flush(self, timeout_s: float = 2.0) -> bool:
+        """Espera a que todo lo encolado hasta ahora esté escrito en disco."""
+        if not self._thread:
+            return True
+        done = threading.Event()
+        self.call(done.set)
+        return done.wait(timeout_s)
+
+    def close(self):
+        self.flush()
+
+    def queued(self) -> int:
+        return self._q.qsize()
+
+    def _writer_for(self, filename: str, headers: list[str]):
+        fw = self._files.get(filename)
+        if fw is None:
+            # Un CSV que ya existe conserva sus columnas (p.ej. uno anterior a
+            # la columna "uid"): mezclar cabeceras rompería a quien lo lee.
+            # Los campos que no estén en la cabecera solo los ven los suscriptores.
+            existing = _csv_header(filename)
+            if existing and existing != headers:
+                log.info(f"{filename}: se conservan sus columnas ({', '.join(existing)})")
+                headers = existing
+            f = open(filename, "a", newline="", encoding="utf-8")
+            w = csv.DictWriter(f, fieldnames=headers, extrasaction="ignore")
+            if f.tell() == 0:
+                w.writeheader()
+            fw = self._files[filename] = (f, w)
+        return fw[1]
+
+    def _flush_files(self):
+        t0 = time.monotonic()
+        for filename, (f, _) in self._files.items():
+            try:
+                f.flush()
+                if self._fsync:
+                    os.fsync(f.fileno())
+            except Exception as e:
+                log.error(f"Error volcando {f.name}: {e}")
+                continue
+            for _, on_flush in self._listeners.get(filename, ()):
+                if on_flush:
+                    on_flush(filename, f.tell())
+        metrics.observe("csv.flush", time.monotonic() - t0)
+
+    def _write_row(self, filename: str, headers: list[str], row: dict) -> bool:
+        try:
+            self._writer_for(filename, headers).writerow(row)
+            metrics.inc("csv.rows")
+        except Exception as e:
+            log.error(f"Error escribiendo {filename}: {e}")
+            return False
+        for on_row, _ in self._listeners.get(filename, ()):
+            if on_row:
+                try:
+                    on_row(row)
+                except Exception as e:
+                    log.error(f"Error procesando fila de {filename}: {e}")
+        return True
+
+    def _run(self):
+        pending = 0
+        next_flush = None
+        while True:
+            timeout = None if next_flush is None else max(0.0, next_flush - time.time())
+            try:
+                item = self._q.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, tuple):
+                if self._write_row(*item):
+                    pending += 1
+                if next_flush is None:
+                    next_flush = time.time() + self._flush_interval_s
+                if pending < self._batch_rows:
+                    continue
+
+            # Volcado: por tamaño, por tiempo o antes de una tarea (call/flush)
+            if pending:
+                self._flush_files()
+            pending = 0
+            next_flush = None
+            if callable(item):
+                try:
+                    item()
+                except Exception as e:
+                    log.error(f"Error en tarea del escritor CSV: {e}")
+
+
+csv_writer = CsvWriter()
+
+
+def _csv_header(filename: str) -> list[str]:
+    """Cabecera de un CSV existente ([] si no existe o está vacío)."""
+    try:
+        with open(filename, "r", newline="", encoding="utf-8-sig", errors="ignore") as f:
+            return next(csv.reader([f.readline()]), [])
+    except OSError:
+        return []
+
+
+def iter_csv_rows_from(filename: str, offset: int):
+    """
+    Filas (dict por cabecera) de `filename` a partir del byte `offset`, que
+    debe ser inicio de registro; 0 o un offset dentro de la cabecera = todas.
+    """
+    with open(filename, "rb") as f:
+        headers = next(csv.reader([f.readline().decode("utf-8-sig", errors="ignore")]), [])
+        if offset > f.tell():
+            f.seek(offset)
+        text = io.TextIOWrapper(f, encoding="utf-8", errors="ignore", newline="")
+        for rec in csv.reader(text):
+            if rec:
+                yield dict(zip(headers, rec))
+
+
+# ------------------ Resumen de ventas incremental ------------------
+
+VEN_SUMMARY_JSON = "ventas_resumen.json"
+SUMMARY_CHECKPOINT_EVERY_S = 10.0
+SUMMARY_FINGERPRINT_BYTES = 256  # identifica el CSV (cabecera + primeras filas)
+
+
+def _price_cents(v) -> int:
+    try:
+        return int(round(float(str(v).replace(",", ".")) * 100))
+    except (TypeError, ValueError):
+        return 0
+
+def _file_fingerprint(filename: str) -> str:
+    with open(filename, "rb") as f:
+        return hashlib.sha1(f.read(SUMMARY_FINGERPRINT_BYTES)).hexdigest()
+
+
+class SalesSummary:
+    """
+    Agregados de ventas mantenidos al vuelo (número, total y desglose por
+    tipo, temporada, día e IP del lector). Se alimenta de las filas que el
+    CsvWriter escribe en ventas.csv y se persiste en un checkpoint con el
+    offset del CSV ya contabilizado; al arrancar solo se relee lo que falte.
+    Los importes se llevan en céntimos para que el total sea exacto.
+    """
+
+    _BREAKDOWNS = ("tipo", "temporada", "dia", "ip")
+
+    def __init__(self, csv_path: str, checkpoint_path: str):
+        self.csv_path = csv_path
+        self.checkpoint_path = checkpoint_path
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._reset()
+
+    def _reset(self):
+        self.count = 0
+        self.total_cents = 0
+        self.by = {k: {} for k in self._BREAKDOWNS}  # clave -> [ventas, céntimos]
+        self._offset = 0
+        self._fingerprint = ""
+        self._fp_offset = 0
+        self._dirty = False
+        self._last_save = 0.0
+
+    def attach(self, writer: CsvWriter):
+        writer.subscribe(self.csv_path, self.apply, self.on_flush)
+        # Cargar en el hilo escritor: así ninguna fila queda a medias entre
+        # el checkpoint y lo que se escriba a partir de ahora.
+        writer.call(self.load)
+
+    def apply(self, row: dict):
+        cents = _price_cents(row.get("precio", "0"))
+        keys = {
+            "tipo": row.get("tipo", "") or "-",
+            "temporada": row.get("temporada", "") or "-",
+            "dia": str(row.get("timestamp", ""))[:10] or "-",
+            "ip": row.get("ip", "") or "-",
+        }
+        with self._lock:
+            if not self._loaded:
+                return
+            self.count += 1
+            self.total_cents += cents
+            for k, v in keys.items():
+                acc = self.by[k].setdefault(v, [0, 0])
+                acc[0] += 1
+                acc[1] += cents
+            self._dirty = True
+
+    def on_flush(self, filename: str, offset: int):
+        with self._lock:
+            if not self._loaded:
+                return
+            self._offset = offset
+            due = self._dirty and time.time() - self._last_save >= SUMMARY_CHECKPOINT_EVERY_S
+        if due:
+            self.save()
+
+    def load(self):
+        """Carga el checkpoint; si falta o no cuadra con el CSV, lo reconstruye."""
+        with self._lock:
+            self._reset()
+            size = os.path.getsize(self.csv_path) if os.path.exists(self.csv_path) else 0
+            fp = _file_fingerprint(self.csv_path) if size else ""
+
+            cp = None
+            try:
+                with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+                    cp = json.load(f)
+            except (OSError, ValueError):
+                cp = None
+
+            if cp and cp.get("fingerprint") == fp and 0 <= cp.get("offset", -1) <= size:
+                self.count = int(cp["count"])
+                self.total_cents = int(cp["total_cents"])
+                self.by = {k: {kk: list(vv) for kk, vv in cp["by"].get(k, {}).items()}
+                           for k in self._BREAKDOWNS}
+                start = cp["offset"]
+            else:
+                start = 0
+
+            self._loaded = True
+
+        # Releer solo lo que se escribió después del checkpoint (o todo si no había)
+        if size > start:
+            self._replay_csv(start)
+
+        with self._lock:
+            self._offset = size
+            self._fingerprint = fp
+            self._fp_offset = size
+            self._dirty = True
+        self.save()
+
+    def _replay_csv(self, start: int):
+        for row in iter_csv_rows_from(self.csv_path, start):
+            self.apply(row)
+
+    def save(self):
+        with self._lock:
+            if not self._loaded:
+                return
+            # La huella de un CSV aún pequeño cambia al crecer: recalcularla
+            if self._offset and self._fp_offset < SUMMARY_FINGERPRINT_BYTES:
+                self._fingerprint = _file_fingerprint(self.csv_path)
+                self._fp_offset = self._offset
+            cp = {
+                "offset": self._offset,
+                "fingerprint": self._fingerprint,
+                "count": self.count,
+                "total_cents": self.total_cents,
+                "by": self.by,
+            }
+            self._dirty = False
+            self._last_save = time.time()
+        tmp = self.checkpoint_path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(cp, f, ensure_ascii=False)
+            os.replace(tmp, self.checkpoint_path)
+        except OSError as e:
+            log.warning(f"No se pudo guardar {self.checkpoint_path}: {e}")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "count": self.count,
+                "total": self.total_cents / 100,
+                "by": {k: {kk: (vv[0], vv[1] / 100) for kk, vv in v.items()}
+                       for k, v in self.by.items()},
+            }
+
+
+sales_summary = SalesSummary(VEN_CSV, VEN_SUMMARY_JSON)
+
+
+# ------------------ Histórico indexado (SQLite) ------------------
+
+EVENT_DB = "eventos.db"
+EVENT_IMPORT_BATCH = 5000
+
+EVENT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS eventos (
+    n         INTEGER PRIMARY KEY,
+    evento    TEXT NOT NULL,      -- MOVE / SOLD
+    ts        TEXT NOT NULL,      -- 'YYYY-MM-DD HH:MM:SS'
+    ip        TEXT,
+    tag_id    INTEGER,
+    uid       TEXT,
+    temporada TEXT,
+    tipo      TEXT,
+    desde     TEXT,
+    hacia     TEXT,
+    precio    REAL
+);
+CREATE INDEX IF NOT EXISTS ix_eventos_ts ON eventos(ts);
+CREATE INDEX IF NOT EXISTS ix_eventos_tag_id ON eventos(tag_id, ts);
+CREATE INDEX IF NOT EXISTS ix_eventos_uid ON eventos(uid, ts);
+CREATE INDEX IF NOT EXISTS ix_eventos_tipo ON eventos(tipo, ts);
+CREATE TABLE IF NOT EXISTS fuentes (
+    fichero TEXT PRIMARY KEY,     -- CSV del que se alimenta
+    offset  INTEGER NOT NULL      -- bytes ya volcados a la base de datos
+);
+"""
+
+
+def _to_int(v):
+    try:
+        return int(str(v).strip())
+    except (TypeError, ValueError):
+        return None
+
+def _to_float(v):
+    try:
+        return float(str(v).replace(",", "."))
+    except (TypeError, ValueError):
+        return None
+
+
+class SqliteEventStore:
+    """
+    Backend de eventos en SQLite (modo WAL) que vive junto a los CSV: recibe
+    las mismas filas que escribe el CsvWriter y las inserta por lotes en cada
+    volcado. Guarda por cada CSV el offset ya importado, así que al activarlo
+    (o tras un tiempo desactivado) importa de una vez lo que falte.
+    """
+
+    SOURCES = {MOV_CSV: "MOVE", VEN_CSV: "SOLD"}
+
+    def __init__(self, path: str = EVENT_DB):
+        self.path = path
+        self._db = None      # conexión del hilo escritor
+        self._batch = {filename: [] for filename in self.SOURCES}
+
+    def attach(self, writer: CsvWriter):
+        for filename in self.SOURCES:
+            writer.subscribe(filename, self._on_row_for(filename), self.on_flush)
+        writer.call(self.open)
+
+    def _connect(self):
+        db = sqlite3.connect(self.path)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def open(self):
+        self._db = self._connect()
+        self._db.executescript(EVENT_SCHEMA)
+        for filename in self.SOURCES:
+            self.import_csv(filename)
+
+    @staticmethod
+    def _event_tuple(evento: str, row: dict):
+        return (
+            evento,
+            row.get("timestamp", ""),
+            row.get("ip", ""),
+            _to_int(row.get("id")),
+            (row.get("uid") or "").upper() or None,
+            row.get("temporada", ""),
+            row.get("tipo", ""),
+            row.get("from") or None,
+            row.get("to") or None,
+            _to_float(row.get("precio")),
+        )
+
+    def _on_row_for(self, filename: str):
+        evento = self.SOURCES[filename]
+        batch = self._batch[filename]
+
+        def on_row(row: dict):
+            if self._db is not None:
+                batch.append(self._event_tuple(evento, row))
+        return on_row
+
+    def _insert(self, rows):
+        self._db.executemany(
+            "INSERT INTO eventos (evento, ts, ip, tag_id, uid, temporada, tipo, desde, hacia, precio)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+
+    def _set_offset(self, filename: str, offset: int):
+        self._db.execute(
+            "INSERT INTO fuentes (fichero, offset) VALUES (?, ?)"
+            " ON CONFLICT(fichero) DO UPDATE SET offset = excluded.offset",
+            (filename, offset),
+        )
+
+    def on_flush(self, filename: str, offset: int):
+        if self._db is None:
+            return
+        # Filas y offset del mismo CSV en una sola transacción
+        batch = self._batch[filename]
+        rows = batch[:]
+        batch.clear()
+        try:
+            with self._db:
+                if rows:
+                    self._insert(rows)
+                self._set_offset(filename, offset)
+        except sqlite3.Error as e:
+            log.error(f"Error guardando eventos en {self.path}: {e}")
+
+    def import_csv(self, filename: str) -> int:
+        """Importa las filas de `filename` que aún no estén en la base de datos."""
+        if not os.path.exists(filename):
+            return 0
+        evento = self.SOURCES[filename]
+        row_ = self._db.execute("SELECT offset FROM fuentes WHERE fichero = ?", (filename,)).fetchone()
+        start = row_[0] if row_ else 0
+        size = os.path.getsize(filename)
+        if start > size:
+            # el CSV se ha sustituido: reimportarlo entero
+            with self._db:
+                self._db.execute("DELETE FROM eventos WHERE evento = ?", (evento,))
+            start = 0
+        if start >= size:
+            return 0
+
+        n = 0
+        batch = []
+        with self._db:
+            for row in iter_csv_rows_from(filename, start):
+                batch.append(self._event_tuple(evento, row))
+                if len(batch) >= EVENT_IMPORT_BATCH:
+                    self._insert(batch)
+                    n += len(batch)
+                    batch = []
+            if batch:
+                self._insert(batch)
+                n += len(batch)
+            self._set_offset(filename, size)
+        if n:
+            log.info(f"[i] Importados {n} eventos de {filename} a {self.path}")
+        return n
+
+    def query(self, evento=None, tag_id=None, uid=None, tipo=None, temporada=None,
+              desde=None, hacia=None, ts_from=None, ts_to=None, limit=50):
+        """Consulta filtrada (usa los índices de ts, tag_id, uid y tipo). Más recientes primero."""
+        where, params = [], []
+        for col, val in (("evento", evento), ("tag_id", tag_id), ("uid", uid),
+                         ("tipo", tipo), ("temporada", temporada),
+                         ("desde", desde), ("hacia", hacia)):
+            if val not in (None, ""):
+                where.append(f"{col} = ?")
+                params.append(val)
+        if ts_from:
+            where.append("ts >= ?")
+            params.append(ts_from)
+        if ts_to:
+            where.append("ts < ?")
+            params.append(ts_to)
+
+        sql = "SELECT evento, ts, ip, tag_id, uid, temporada, tipo, desde, hacia, precio FROM eventos"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY ts DESC, n DESC LIMIT ?"
+        params.append(int(limit))
+
+        db = sqlite3.connect(self.path)  # conexión propia: el escritor tiene la suya
+        try:
+            cols = ["evento", "ts", "ip", "id", "uid", "temporada", "tipo", "from", "to", "precio"]
+            return cols, db.execute(sql, params).fetchall()
+        finally:
+            db.close()
 
-def append_csv(filename: str, headers: list[str], row: dict):
-    file_exists = os.path.exists(filename)
-    with open(filename, "a", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=headers)
-        if not file_exists:
-            w.writeheader()
-        w.writerow(row)
+
+event_store = None  # SqliteEventStore si se arranca con --sqlite
+
+
+def append_csv(filename: str, headers: list[str], row: dict, durable: bool = False) -> bool:
+    return csv_writer.submit(filename, headers, row, durable=durable)
+
+def _parse_rows(chunk: bytes, headers: list[str], strict: bool, inside: bool = False):
+    """
+    Parsea un trozo de CSV. Con inside=False el trozo empieza en inicio de
+    registro; con inside=True empieza dentro de un campo entrecomillado, y el
+    primer registro (la cola del que quedó cortado) se descarta. En modo
+    estricto devuelve None si algo no cuadra (número de campos o comillas).
+    """
+    text = chunk.decode("utf-8", errors="ignore")
+    if inside:
+        text = '"' + text
+    rows = []
+    first = inside
+    try:
+        for rec in csv.reader(io.StringIO(text, newline=""), strict=strict):
+            if first:
+                first = False
+                if len(rec) > len(headers):
+                    return None
+                continue
+            if not rec:
+                continue
+            if len(rec) != len(headers):
+                if strict:
+                    return None
+                rec = (rec + [""] * len(headers))[:len(headers)]
+            rows.append(dict(zip(headers, rec)))
+    except csv.Error:
+        if strict:
+            return None
+    return rows
 
 def read_last_rows(filename: str, limit: int = 20):
+    """
+    Devuelve (headers, últimas `limit` filas) leyendo el fichero desde el
+    final por bloques: solo se leen los bytes necesarios, no el CSV entero.
+
+    Un salto de línea tras el que empieza el bloque puede ser fin de registro
+    o estar dentro de un campo entrecomillado. Se prueban las dos lecturas:
+    solo si la de "dentro de comillas" es imposible se da por buena la otra;
+    si ambas cuadran, el bloque se amplía hacia atrás hasta que se decida (o
+    se llegue al principio del fichero, donde no hay duda).
+    """
+    csv_writer.flush()
     if not os.path.exists(filename):
         return [], []
-    with open(filename, "r", newline="", encoding="utf-8") as f:
-        r = csv.DictReader(f)
-        rows = list(r)
-        headers = r.fieldnames or []
-    return headers, rows[-limit:]
+    with open(filename, "rb") as f:
+        header_line = f.readline()
+        headers = next(csv.reader([header_line.decode("utf-8-sig", errors="ignore")]), [])
+        data_start = f.tell()
+        end = f.seek(0, os.SEEK_END)
+        if not headers or end <= data_start or limit <= 0:
+            return headers, []
+
+        block = TAIL_BLOCK_BYTES
+        while True:
+            start = max(data_start, end - block)
+            f.seek(start)
+            chunk = f.read(end - start)
+
+            if start > data_start:
+                # descartar el registro (probablemente) cortado del principio
+                nl = chunk.find(b"\n")
+                if nl == -1:
+                    block *= 2
+                    continue
+                chunk = chunk[nl + 1:]
+                rows = _parse_rows(chunk, headers, strict=True)
+                if (rows is not None and len(rows) >= limit
+                        and _parse_rows(chunk, headers, strict=True, inside=True) is None):
+                    return headers, rows[-limit:]
+                block *= 2
+                continue
+
+            # hemos llegado al principio: el trozo es todo el fichero
+            rows = _parse_rows(chunk, headers, strict=False)
+            return headers, rows[-limit:]
 
 
 # ------------------ Tabla bonita (ANSI-safe) ------------------
@@ -133,461 +1065,2092 @@ def color_ubicacion(ubi: str) -> str:
     return ubi
 
 
+# ------------------ Correlación de respuestas ------------------
+
+class Waiter:
+    """Espera de una única petición (un rid de PING/READUID, o el ACK de un cid)."""
+
+    __slots__ = ("key", "cv", "responses", "arrivals", "expires", "sent_at")
+
+    def __init__(self, key, ttl_s: float):
+        self.key = key
+        self.cv = threading.Condition()
+        self.responses = {}  # origen (cid) -> valor
+        self.arrivals = []   # orden de llegada: permite evaluar solo lo nuevo
+        self.expires = time.time() + ttl_s
+        self.sent_at = time.monotonic()  # para medir el RTT de las respuestas
+
+    def deliver(self, src, value):
+        with self.cv:
+            if src not in self.responses:
+                self.arrivals.append(src)
+            self.responses[src] = value
+            self.cv.notify_all()
+
+    def extend(self, ttl_s: float):
+        self.expires = max(self.expires, time.time() + ttl_s)
+
+    def wait_until(self, ready, timeout_s: float) -> bool:
+        """Espera hasta que ready(self) sea cierto (se evalúa con el lock tomado)."""
+        deadline = time.time() + timeout_s
+        with self.cv:
+            while not ready(self):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.cv.wait(timeout=remaining)
+            return True
+
+
+class Correlator:
+    """
+    Registro clave -> Waiter. process_message despacha cada respuesta en O(1)
+    a su única espera; lo que llega tarde (sin espera registrada) se descarta.
+    Las esperas abandonadas caducan por TTL.
+    """
+
+    def __init__(self, sweep_every_s: float = WAITER_SWEEP_EVERY_S):
+        self._lock = threading.Lock()
+        self._waiters = {}
+        self._sweep_every_s = sweep_every_s
+        self._next_sweep = time.time() + sweep_every_s
+        self.dropped = 0
+
+    def register(self, key, ttl_s: float) -> Waiter:
+        w = Waiter(key, ttl_s)
+        now = time.time()
+        with self._lock:
+            if now >= self._next_sweep:
+                self._evict_expired(now)
+            self._waiters[key] = w
+        return w
+
+    def unregister(self, w: Waiter):
+        with self._lock:
+            if self._waiters.get(w.key) is w:
+                del self._waiters[w.key]
+
+    def dispatch(self, key, src, value):
+        """Entrega la respuesta a su espera y la devuelve (None si nadie esperaba)."""
+        with self._lock:
+            w = self._waiters.get(key)
+            if w is None:
+                self.dropped += 1
+                return None
+        w.deliver(src, value)
+        return w
+
+    def _evict_expired(self, now: float):
+        for key in [k for k, w in self._waiters.items() if w.expires <= now]:
+            del self._waiters[key]
+        self._next_sweep = now + self._sweep_every_s
+
+    def __len__(self):
+        return len(self._waiters)
+
+
+correlator = Correlator()
+
+
+# ------------------ Ejecutor de escaneos ------------------
+
+SCAN_WORKERS = 8
+SCAN_QUEUE_MAX = 256  # tareas pendientes antes de responder BUSY
+
+# Clases de prioridad (menor = antes)
+PRIO_BOX = 0    # cobro en caja
+PRIO_DOOR = 1   # movimientos por la puerta
+PRIO_ADMIN = 2  # consultas del menú
+
+
+class ScanExecutor:
+    """
+    Pool de hilos con prioridades. Las tareas con la misma clave (p.ej. el
+    mismo lector NFC) se ejecutan de una en una y en orden de llegada; entre
+    claves distintas manda la prioridad. Si hay demasiadas tareas pendientes,
+    submit() devuelve None para que quien llama avise (BUSY) en vez de esperar.
+    """
+
+    def __init__(self, workers: int = SCAN_WORKERS, max_pending: int = SCAN_QUEUE_MAX):
+        self._workers = workers
+        self._max_pending = max_pending
+        self._cv = threading.Condition()
+        self._ready = []    # heap (prio, seq, key): claves con trabajo listo
+        self._per_key = {}  # key -> deque[(prio, fn, args, future)]
+        self._pending = 0
+        self._seq = itertools.count()
+        self._started = False
+
+    def _ensure_started(self):
+        if self._started:
+            return
+        self._started = True
+        for i in range(self._workers):
+            threading.Thread(target=self._worker, name=f"scan-{i}", daemon=True).start()
+
+    def submit(self, prio: int, key, fn, *args):
+        fut = Future()
+        with self._cv:
+            self._ensure_started()
+            if self._pending >= self._max_pending:
+                return None
+            q = self._per_key.get(key)
+            if q is None:
+                q = self._per_key[key] = deque()
+                heapq.heappush(self._ready, (prio, next(self._seq), key))
+            q.append((prio, fn, args, fut))
+            self._pending += 1
+            self._cv.notify()
+        return fut
+
+    def pending(self) -> int:
+        return self._pending
+
+    def _worker(self):
+        while True:
+            with self._cv:
+                while not self._ready:
+                    self._cv.wait()
+                _, _, key = heapq.heappop(self._ready)
+                q = self._per_key[key]
+                _, fn, args, fut = q.popleft()
+
+            if fut.set_running_or_notify_cancel():
+                try:
+                    fut.set_result(fn(*args))
+                except BaseException as e:
+                    fut.set_exception(e)
+                    log.error(f"Error en tarea {getattr(fn, '__name__', fn)}: {e}")
+
+            with self._cv:
+                self._pending -= 1
+                # La siguiente tarea de esta clave solo entra cuando acaba la actual
+                if q:
+                    heapq.heappush(self._ready, (q[0][0], next(self._seq), key))
+                    self._cv.notify()
+                else:
+                    del self._per_key[key]
+
+
+scan_executor = ScanExecutor()
+
+
+def admin_poll(**kwargs):
+    """poll_tags() desde el menú, con prioridad ADMIN. None si el servidor está saturado."""
+    fut = scan_executor.submit(PRIO_ADMIN, "ADMIN", lambda: poll_tags(**kwargs))
+    if fut is None:
+        return None
+    return fut.result()
+
+
+# ------------------ Registro de etiqueta ------------------
+
+class TagRecord:
+    """
+    Contenido de una etiqueta (PONG DATA, SET), decodificado y normalizado una
+    sola vez al recibirlo. Inmutable por convenio: para cambiar un campo se
+    usa replace(), así se puede compartir entre hilos sin copiarlo.
+    """
+
+    __slots__ = ("id", "temporada", "tipo", "ubicacion", "precio", "uid")
+
+    def __init__(self, id, temporada="", tipo="", ubicacion="", precio=0.0, uid=""):
+        self.id = id
+        self.temporada = temporada
+        self.tipo = tipo
+        self.ubicacion = ubicacion
+        self.precio = precio
+        self.uid = uid
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "TagRecord":
+        # id: int, o None si la etiqueta no manda un ID numérico
+        try:
+            tag_id = int(d["ID"])
+        except (KeyError, TypeError, ValueError):
+            tag_id = None
+        try:
+            precio = float(d.get("Precio", 0.0))
+        except (TypeError, ValueError):
+            precio = 0.0
+        return cls(
+            tag_id,
+            str(d.get("Temporada", "")),
+            str(d.get("Tipo", "")),
+            str(d.get("Ubicacion", "")).strip(),
+            precio,
+            str(d.get("UID", "")).strip().upper(),
+        )
+
+    @classmethod
+    def from_json(cls, payload: str):
+        """None si el payload no es un objeto JSON."""
+        try:
+            d = json_loads(payload)
+        except ValueError:
+            return None
+        return cls.from_dict(d) if isinstance(d, dict) else None
+
+    def replace(self, **fields) -> "TagRecord":
+        t = TagRecord(self.id, self.temporada, self.tipo, self.ubicacion, self.precio, self.uid)
+        for k, v in fields.items():
+            setattr(t, k, v)
+        return t
+
+    def to_dict(self) -> dict:
+        # Mismas claves que espera el firmware en SET
+        return {"ID": self.id, "Temporada": self.temporada, "Tipo": self.tipo,
+                "Ubicacion": self.ubicacion, "Precio": self.precio, "UID": self.uid}
+
+    def to_json(self) -> str:
+        return json_dumps(self.to_dict())
+
+
+# ------------------ Índices secundarios de stock ------------------
+
+STOCK_FIELDS = ("tipo", "temporada", "ubicacion")
+STOCK_PAGE_SIZE = 20
+
+
+def _facet_key(v) -> str:
+    return str(v).strip().casefold()
+
+
+class StockIndex:
+    """
+    Índices en memoria sobre las etiquetas con datos de tag_index: un
+    valor -> {cids} por Tipo, Temporada y Ubicacion, y una lista ordenada de
+    (precio, cid) para rangos con bisect. Se actualiza junto a tag_index
+    (con tags_lock tomado), así una consulta no toca la red ni recorre la flota.
+    """
+
+    def __init__(self):
+        self._by = {f: {} for f in STOCK_FIELDS}  # campo -> clave -> set(cid)
+        self._labels = {f: {} for f in STOCK_FIELDS}  # campo -> clave -> texto original
+        self._prices = []  # [(precio, cid)] ordenada
+
+    def add(self, cid: int, tag: TagRecord):
+        for f in STOCK_FIELDS:
+            v = getattr(tag, f)
+            k = _facet_key(v)
+            self._by[f].setdefault(k, set()).add(cid)
+            self._labels[f].setdefault(k, v)
+        bisect.insort(self._prices, (tag.precio, cid))
+
+    def remove(self, cid: int, tag: TagRecord):
+        for f in STOCK_FIELDS:
+            k = _facet_key(getattr(tag, f))
+            cids = self._by[f].get(k)
+            if cids is not None:
+                cids.discard(cid)
+                if not cids:
+                    del self._by[f][k]
+                    del self._labels[f][k]
+        i = bisect.bisect_left(self._prices, (tag.precio, cid))
+        if i < len(self._prices) and self._prices[i] == (tag.precio, cid):
+            del self._prices[i]
+
+    def __len__(self):
+        return len(self._prices)
+
+    def values(self, field: str):
+        """[(valor, nº de etiquetas)] de un campo, para ofrecer los filtros."""
+        return sorted((self._labels[field][k], len(cids)) for k, cids in self._by[field].items())
+
+    def match(self, precio_min=None, precio_max=None, **filters):
+        """Conjunto de cids que cumplen todos los filtros (None = sin filtrar ese campo)."""
+        sets = []
+        for f, v in filters.items():
+            if v is None or v == "":
+                continue
+            cids = self._by[f].get(_facet_key(v))
+            if not cids:
+                return set()
+            sets.append(cids)
+        sets.sort(key=len)
+
+        price_last = False
+        if precio_min is not None or precio_max is not None:
+            lo = 0 if precio_min is None else bisect.bisect_left(self._prices, (precio_min, -1))
+            hi = len(self._prices) if precio_max is None else bisect.bisect_right(
+                self._prices, (precio_max, float("inf")))
+            if not sets or hi - lo <= len(sets[0]):
+                # El rango es lo más selectivo: se parte de él
+                sets.insert(0, {cid for _, cid in self._prices[lo:hi]})
+            else:
+                price_last = True  # pocas candidatas: se mira su precio al final
+
+        if not sets:
+            # Sin filtros: todas las etiquetas con datos
+            return {cid for _, cid in self._prices}
+        out = set(sets[0])
+        for cids in sets[1:]:
+            out &= cids
+            if not out:
+                return out
+        if price_last:
+            pmin = float("-inf") if precio_min is None else precio_min
+            pmax = float("inf") if precio_max is None else precio_max
+            out = {cid for cid in out if pmin <= tag_index[cid]["tag"].precio <= pmax}
+        return out
+
+
+stock_index = StockIndex()
+
+
+def query_stock(page: int = 1, per_page: int = STOCK_PAGE_SIZE, **filters):
+    """
+    Filtra el stock en caché por tipo, temporada, ubicacion, precio_min y
+    precio_max, ordenado por ID, y devuelve una página:
+    {"total", "page", "pages", "rows": [(cid, TagRecord, ts)]}.
+    """
+    t0 = time.monotonic()
+    with tags_lock:
+        cids = stock_index.match(**filters)
+        total = len(cids)
+        pages = max(1, -(-total // per_page))
+        page = min(max(1, page), pages)
+        ordered = sorted(cids, key=_stock_order)
+        rows = [(cid, tag_index[cid]["tag"], tag_index[cid]["ts"])
+                for cid in ordered[(page - 1) * per_page:page * per_page]]
+    metrics.observe("stock.query", time.monotonic() - t0)
+    return {"total": total, "page": page, "pages": pages, "rows": rows}
+
+
+def _stock_order(cid: int):
+    # Con tags_lock tomado. Por ID; las etiquetas sin ID van al final
+    tag_id = tag_index[cid]["tag"].id
+    return (tag_id is None, tag_id or 0, cid)
+
+
+def count_stock(**filters) -> int:
+    with tags_lock:
+        return len(stock_index.match(**filters))
+
+
+# ------------------ Índice UID -> etiqueta ------------------
+
+def _drop_uid(cid: int, old):
+    # Con tags_lock tomado
+    if old and old["tag"] is not None:
+        stock_index.remove(cid, old["tag"])
+        old_uid = old["tag"].uid
+        if uid_index.get(old_uid) == cid:
+            del uid_index[old_uid]
+
+def index_tag(cid: int, tag: TagRecord, ts: float = None):
+    global tag_index_version
+    uid = tag.uid
+    with tags_lock:
+        if cid in quarantined_tags:
+            return  # puede llevar el UID de una prenda que ya confirmó otra etiqueta
+        tag_index_version += 1
+        old = tag_index.get(cid)
+        if old and old["tag"] is not None:
+            if old["tag"].uid != uid:
+                _drop_uid(cid, old)
+            else:
+                stock_index.remove(cid, old["tag"])
+        tag_index[cid] = {"tag": tag, "ts": time.time() if ts is None else ts}
+        stock_index.add(cid, tag)
+        if uid:
+            uid_index[uid] = cid
+
+def mark_empty(cid: int):
+    """La etiqueta está VACÍA (PONG EMPTY, venta o reset): sale del índice UID, sigue en la caché."""
+    global tag_index_version
+    with tags_lock:
+        tag_index_version += 1
+        pending_sets.pop(cid, None)
+        _drop_uid(cid, tag_index.get(cid))
+        tag_index[cid] = {"tag": None, "ts": time.time()}
+
+def unindex_tag(cid: int):
+    """Saca la etiqueta de los índices y devuelve su entrada (o None)."""
+    global tag_index_version
+    with tags_lock:
+        tag_index_version += 1
+        pending_sets.pop(cid, None)
+        reserved_tags.discard(cid)  # fin de una reserva de alta masiva
+        quarantined_tags.discard(cid)
+        entry = tag_index.pop(cid, None)
+        _drop_uid(cid, entry)
+        return entry
+
+def update_indexed_tag(cid: int, **fields):
+    global tag_index_version
+    with tags_lock:
+        entry = tag_index.get(cid)
+        if not entry or entry["tag"] is None:
+            return
+        tag_index_version += 1
+        stock_index.remove(cid, entry["tag"])
+        entry["tag"] = entry["tag"].replace(**fields)
+        entry["ts"] = time.time()
+        stock_index.add(cid, entry["tag"])
+
+def indexed_uid(cid: int) -> str:
+    with tags_lock:
+        entry = tag_index.get(cid)
+        return entry["tag"].uid if entry and entry["tag"] is not None else ""
+
+def held_for_bulk(cid: int) -> bool:
+    """La etiqueta está apartada o en cuarentena por una alta masiva: no se ofrece para alta."""
+    return cid in reserved_tags or cid in quarantined_tags
+
+def quarantine_tag(cid: int):
+    """Saca la etiqueta de la alta y de los índices; sus PONG DATA se ignoran hasta que se desconecte."""
+    global tag_index_version
+    with tags_lock:
+        tag_index_version += 1
+        pending_sets.pop(cid, None)
+        reserved_tags.discard(cid)
+        quarantined_tags.add(cid)
+        _drop_uid(cid, tag_index.pop(cid, None))
+
+def lookup_uid(uid_hex: str):
+    with tags_lock:
+        cid = uid_index.get(uid_hex)
+        entry = tag_index.get(cid) if cid is not None else None
+        return (cid, entry["tag"]) if entry and entry["tag"] is not None else (None, None)
+
+def send_set(cid: int, sess, tag: TagRecord):
+    """Envía SET y lo deja pendiente: el índice solo cambia cuando llega el ACK."""
+    with tags_lock:
+        pending_sets[cid] = (tag, time.monotonic())
+    send_line(sess, "SET " + tag.to_json())
+
+
+# ------------------ IDs y registro persistentes ------------------
+
+TAG_IDS_JSON = "tag_ids.json"
+ID_LEASE_BLOCK = 64           # IDs reservados por escritura (y fsync) del fichero
+REGISTRY_JSON = "registro_etiquetas.json"
+REGISTRY_SAVE_EVERY_S = 10.0
+
+
+def _write_atomic(path: str, data: bytes):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def max_id_in_csvs(*filenames) -> int:
+    """Mayor ID que aparece en los CSV de movimientos/ventas (0 si no hay)."""
+    top = 0
+    for filename in filenames:
+        try:
+            with open(filename, "r", newline="", encoding="utf-8-sig", errors="ignore") as f:
+                for row in csv.DictReader(f):
+                    v = _to_int(row.get("id"))
+                    if v is not None and v > top:
+                        top = v
+        except OSError:
+            continue
+    return top
+
+
+class TagIdAllocator:
+    """
+    IDs de etiqueta que no se repiten entre reinicios. En disco solo está el
+    final del bloque concedido (leased_until): se reservan ID_LEASE_BLOCK IDs
+    por escritura, con un fsync por bloque y no por ID. Tras una caída se
+    pierde como mucho lo que quedaba del bloque (huecos), nunca se repite un ID.
+    """
+
+    def __init__(self, path: str, block: int = ID_LEASE_BLOCK):
+        self.path = path
+        self.block = block
+        self._lock = threading.Lock()
+        self._next = 1
+        self._leased_until = 1  # primer ID fuera del bloque concedido
+
+    def load(self, floor: int = 1):
+        """
+        Sigue donde acabó el último bloque. Sin fichero (primer arranque o
+        migración) parte del mayor ID de los CSV; `floor` es el primer ID libre
+        según otros datos (el registro).
+        """
+        try:
+            with open(self.path, "rb") as f:
+                start = int(json_loads(f.read())["leased_until"])
+        except (OSError, ValueError, KeyError, TypeError):
+            start = max_id_in_csvs(MOV_CSV, VEN_CSV) + 1
+            log.info(f"{self.path} no disponible: IDs a partir de {max(start, floor)} (según CSV)")
+        with self._lock:
+            self._next = max(start, floor, 1)
+            self._leased_until = self._next
+
+    def allocate(self) -> int:
+        with self._lock:
+            if self._next >= self._leased_until:
+                until = self._next + self.block
+                _write_atomic(self.path, json_dumps({"leased_until": until}).encode("utf-8"))
+                self._leased_until = until
+            tag_id = self._next
+            self._next += 1
+            return tag_id
+
+    def peek(self) -> int:
+        with self._lock:
+            return self._next
+
+
+tag_ids = TagIdAllocator(TAG_IDS_JSON)
+
+
+class TagRegistry:
+    """
+    Foto compacta de las etiquetas con datos: por UID, su ID, atributos,
+    última ubicación e IP. Se guarda cada REGISTRY_SAVE_EVERY_S (si hubo
+    cambios) y al salir, y se carga al arrancar. Cuando una etiqueta se
+    conecta desde la IP de una entrada guardada, esa entrada pasa a su cid:
+    el índice UID responde a los escaneos sin esperar a un poll de toda la
+    flota (el PING de verificación del escaneo sigue confirmando el dato).
+
+    Las etiquetas desconectadas se quedan "aparcadas" aquí hasta que vuelven.
+    Si varias comparten IP (NAT, pruebas en localhost) no se reasigna ninguna:
+    sin IP única no se sabe cuál es cuál.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._parked = {}      # UID -> (TagRecord, ts, ip)
+        self._by_ip = {}       # ip -> UID, solo IPs con una única etiqueta aparcada
+        self._shared_ips = set()
+        self._saved_version = None
+        self._thread = None
+        self.enabled = False
+        self.rebound = 0
+
+    def load(self) -> int:
+        """Carga la foto; devuelve el mayor ID que contiene (0 si no hay)."""
+        self.enabled = bool(self.path)
+        if not self.enabled:
+            return 0
+        t0 = time.perf_counter()
+        try:
+            with open(self.path, "rb") as f:
+                rows = json_loads(f.read())["tags"]
+        except OSError:
+            return 0
+        except (ValueError, KeyError, TypeError) as e:
+            log.warning(f"{self.path} ilegible, se ignora: {e}")
+            return 0
+
+        if not isinstance(rows, list):
+            log.warning(f"{self.path} ilegible, se ignora: 'tags' no es una lista")
+            return 0
+
+        top = loaded = bad = 0
+        for row in rows:
+            try:
+                uid, tag_id, temporada, tipo, ubicacion, precio, ip, ts = row
+                tag = TagRecord(int(tag_id), str(temporada), str(tipo), str(ubicacion),
+                                float(precio), str(uid).strip().upper())
+                entry = {"tag": tag, "ts": float(ts)}
+                ip = str(ip)
+            except (ValueError, TypeError):
+                bad += 1
+                continue
+            if not tag.uid:
+                bad += 1
+                continue
+            self.park(ip, entry)
+            top = max(top, tag.id)
+            loaded += 1
+        if bad:
+            log.warning(f"{self.path}: {bad} entradas mal formadas ignoradas")
+        log.info(f"Registro: {loaded} etiquetas cargadas de {self.path} "
+                 f"en {(time.perf_counter() - t0) * 1000:.1f} ms")
+        return top
+
+    def park(self, ip: str, entry):
+        """Guarda una etiqueta que se desconecta (entry de tag_index) hasta que vuelva."""
+        if not entry or entry["tag"] is None:
+            return
+        tag = entry["tag"]
+        with self._lock:
+            self._parked[tag.uid] = (tag, entry["ts"], ip)
+            other = self._by_ip.get(ip)
+            if ip in self._shared_ips or (other is not None and other != tag.uid):
+                self._shared_ips.add(ip)
+                self._by_ip.pop(ip, None)
+            else:
+                self._by_ip[ip] = tag.uid
+
+    def rebind(self, cid: int, ip: str):
+        """Una etiqueta conecta: si su IP identifica una entrada aparcada, se indexa ya."""
+        with self._lock:
+            uid = self._by_ip.pop(ip, None)
+            parked = self._parked.pop(uid, None) if uid is not None else None
+        if parked is None:
+            return
+        tag, ts, _ = parked
+        if lookup_uid(tag.uid)[0] is not None:
+            return  # ese UID ya lo tiene otra etiqueta conectada
+        index_tag(cid, tag, ts=ts)
+        self.rebound += 1
+        log.info(f"Registro: client_id={cid} ({ip}) recupera ID={tag.id} UID={tag.uid}")
+
+    def start(self):
+        if self.enabled and self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(REGISTRY_SAVE_EVERY_S)
+            try:
+                self.save()
+            except Exception as e:
+                log.warning(f"No se pudo guardar {self.path}: {e}")
+
+    def save(self):
+        if not self.enabled:
+            return
+        live = []
+        with tags_lock:
+            version = (tag_index_version, len(self._parked))
+            if version == self._saved_version:
+                return
+            for cid, entry in tag_index.items():
+                tag = entry["tag"]
+                sess = clients.get(cid)
+                if tag is not None and sess is not None:
+                    live.append((tag, entry["ts"], sess.addr[0]))
+        live_uids = {tag.uid for tag, _, _ in live}
+        with self._lock:
+            # Un UID que ya está en una etiqueta conectada deja de estar aparcado
+            for uid in live_uids.intersection(self._parked):
+                _, _, ip = self._parked.pop(uid)
+                if self._by_ip.get(ip) == uid:
+                    del self._by_ip[ip]
+            rows = live + list(self._parked.values())
+        data = json_dumps({
+            "version": 1,
+            "saved": now_iso(),
+            "tags": [[t.uid, t.id, t.temporada, t.tipo, t.ubicacion, t.precio, ip, ts]
+                     for t, ts, ip in rows],
+        })
+        try:
+            _write_atomic(self.path, data.encode("utf-8"))
+        except OSError as e:
+            log.warning(f"No se pudo guardar {self.path}: {e}")
+            return
+        self._saved_version = version
+
+    def __len__(self):
+        return len(self._parked)
+
+
+registry = TagRegistry(REGISTRY_JSON)
+
+
 # ------------------ Networking ------------------
 
-def handle_client(client_id: int):
-    with clients_lock:
-        conn = clients[client_id]["conn"]
-        addr = clients[client_id]["addr"]
+class Session:
+    """Estado de una conexión (etiqueta o lector NFC). __slots__: sin dict por instancia."""
+
+    __slots__ = ("cid", "conn", "addr", "configured", "last_seen", "buffer",
+                 "tag_data", "role", "nfc_role",
+                 "out", "out_lock", "want_write", "slow", "closed", "probe_sent")
+
+    def __init__(self, cid: int, conn: socket.socket, addr):
+        self.cid = cid
+        self.conn = conn
+        self.addr = addr
+        self.configured = False  # ya NO es fuente de verdad
+        self.last_seen = time.time()
+        self.buffer = bytearray()
+        self.tag_data = None
+        self.role = "TAG"        # Por defecto NFC por el contrario
+        self.nfc_role = None     # Caja / Puerta
+        self.out = bytearray()   # salida pendiente (la vacía el bucle)
+        self.out_lock = threading.Lock()
+        self.want_write = False  # EVENT_WRITE pedido al selector
+        self.slow = False        # por encima de OUT_HIGH_WATER: no se le espera en los polls
+        self.closed = False
+        self.probe_sent = 0.0    # hora del sondeo de vivacidad pendiente (0 = ninguno)
+
+    def is_live(self, now: float) -> bool:
+        """False si va lento o no ha contestado a un sondeo de vivacidad."""
+        if self.slow:
+            return False
+        return not (self.probe_sent and self.last_seen < self.probe_sent
+                    and now - self.probe_sent > PROBE_SUSPECT_S)
+
+
+class SessionRegistry:
+    """
+    cid -> Session. Las lecturas no toman lock (get y copia de un dict son
+    atómicas bajo el GIL); el lock solo serializa altas y bajas.
+
+    Quién escribe cada campo de Session:
+      - cid, conn, addr: fijos desde la creación.
+      - buffer, last_seen, role, nfc_role: solo el bucle de red.
+      - out, want_write, closed: cualquier hilo, siempre con out_lock.
+      - slow: send_line lo pone a True desde cualquier hilo (sin lock) y el
+        bucle lo limpia con out_lock; es un bool suelto, y una lectura
+        atrasada solo hace que un poll espere (o no) a ese cliente una vez.
+      - probe_sent: solo el hilo de vivacidad (LivenessManager).
+      - configured, tag_data: los hilos del menú/alta; informativos, la
+        verdad está en tag_index (con tags_lock).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_cid = {}
+        self._ids = itertools.count(1)
+
+    def add(self, conn: socket.socket, addr) -> Session:
+        with self._lock:
+            sess = Session(next(self._ids), conn, addr)
+            self._by_cid[sess.cid] = sess
+        return sess
+
+    def remove(self, cid: int):
+        with self._lock:
+            return self._by_cid.pop(cid, None)
 
-    print(f"[{now_ts()}] [+] Cliente conectado: {addr} (client_id={client_id})")
+    def get(self, cid: int):
+        return self._by_cid.get(cid)
 
+    def snapshot(self, cids=None):
+        """Lista de (cid, Session): todas, o solo las de `cids` que sigan conectadas."""
+        if cids is None:
+            return list(self._by_cid.items())
+        out = []
+        for cid in cids:
+            sess = self._by_cid.get(cid)
+            if sess:
+                out.append((cid, sess))
+        return out
+
+    def __contains__(self, cid):
+        return cid in self._by_cid
+
+    def __len__(self):
+        return len(self._by_cid)
+
+
+clients = SessionRegistry()
+
+
+# ------------------ Envío no bloqueante ------------------
+
+_WAKE = object()  # marca del socket de despertar en el selector
+_wake_r, _wake_w = socket.socketpair()
+_wake_r.setblocking(False)
+_wake_w.setblocking(False)
+_loop_calls = deque()
+_loop_thread_id = None
+
+
+def call_in_loop(fn, *args):
+    """Ejecuta fn(*args) en el hilo del bucle (único que toca el selector)."""
+    _loop_calls.append((fn, args))
     try:
-        send_line(conn, "Etiqueta conectada al servidor.")
+        _wake_w.send(b"\0")
+    except (BlockingIOError, InterruptedError):
+        pass  # ya hay un despertar pendiente
+    except OSError:
+        pass
 
-        while True:
-            data = conn.recv(1024)
-            if not data:
-                break
+def _run_loop_calls():
+    while _loop_calls:
+        fn, args = _loop_calls.popleft()
+        try:
+            fn(*args)
+        except Exception as e:
+            log.error(f"Error en tarea del bucle: {e}")
+
+def in_loop_thread() -> bool:
+    return threading.get_ident() == _loop_thread_id
+
+
+def send_line(sess: Session, text: str, kind: str = "out"):
+    """
+    Encola una línea para el cliente sin bloquear nunca al que llama. Si la
+    cola está vacía se intenta enviar ya; lo que no quepa lo vacía el bucle
+    cuando el socket sea escribible. Un cliente que acumula demasiada salida
+    se marca como lento y, si sigue creciendo, se desconecta. `kind` es el
+    tipo de registro en el diario de captura.
+    """
+    if journal is not None:
+        journal.record(sess.cid, kind, text)
+    data = (text + "\n").encode("utf-8", errors="ignore")
+    arm = False
+    with sess.out_lock:
+        if sess.closed:
+            raise ConnectionError("cliente desconectado")
+        if not sess.out:
+            try:
+                n = sess.conn.send(data)
+            except (BlockingIOError, InterruptedError):
+                n = 0
+            if n == len(data):
+                return
+            data = data[n:]
+        sess.out += data
+        pending = len(sess.out)
+        if not sess.want_write:
+            sess.want_write = arm = True
+
+    if pending > OUT_MAX_BYTES:
+        log.warning(f"{sess.addr} no lee ({pending} bytes pendientes): se desconecta")
+        close_client(sess.cid)
+        raise ConnectionError("cliente demasiado lento")
+    if pending > OUT_HIGH_WATER and not sess.slow:
+        sess.slow = True
+        log.warning(f"{sess.addr} va lento ({pending} bytes pendientes)")
+    if arm:
+        call_in_loop(_arm_write, sess)
+
+
+def _arm_write(sess: Session):
+    if sess.closed:
+        return
+    try:
+        selector.modify(sess.conn, selectors.EVENT_READ | selectors.EVENT_WRITE, sess)
+    except (KeyError, ValueError, OSError):
+        pass
+
+
+def _flush_out(sess: Session):
+    with sess.out_lock:
+        if sess.closed:
+            return
+        try:
+            n = sess.conn.send(sess.out)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            err = e
+        else:
+            err = None
+            del sess.out[:n]
+            if len(sess.out) < OUT_LOW_WATER:
+                sess.slow = False
+            if not sess.out:
+                sess.want_write = False
+                try:
+                    selector.modify(sess.conn, selectors.EVENT_READ, sess)
+                except (KeyError, ValueError, OSError):
+                    pass
+    if err is not None:
+        log.error(f"Error enviando a {sess.addr}: {err}")
+        close_client(sess.cid)
+
+
+def _enable_keepalive(conn: socket.socket):
+    try:
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE_S)
+        if hasattr(socket, "TCP_KEEPINTVL"):
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE_INTVL_S)
+        if hasattr(socket, "TCP_KEEPCNT"):
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KEEPALIVE_CNT)
+    except OSError:
+        pass
+
+
+def _raise_nofile_limit():
+    # Con miles de etiquetas el límite por defecto de descriptores (1024) se queda corto
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or hard > soft:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except Exception:
+        pass
+
+
+def _accept_clients(srv: socket.socket):
+    while True:
+        try:
+            conn, addr = srv.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            log.error(f"Error en accept: {e}")
+            return
 
-            with clients_lock:
-                clients[client_id]["last_seen"] = time.time()
-                clients[client_id]["buffer"] += data
-                buf = clients[client_id]["buffer"]
+        # Todo no bloqueante: los envíos pasan por la cola de salida (send_line)
+        conn.setblocking(False)
+        _enable_keepalive(conn)
 
-            while b"\n" in buf:
-                line, buf = buf.split(b"\n", 1)
-                msg = line.decode("utf-8", errors="ignore").strip()
-                if msg:
-                    process_message(client_id, msg)
+        sess = clients.add(conn, addr)
+        cid = sess.cid
 
-            with clients_lock:
-                if client_id in clients:
-                    clients[client_id]["buffer"] = buf
+        selector.register(conn, selectors.EVENT_READ, sess)
+        liveness.track(sess)
+        registry.rebind(cid, addr[0])
+        if journal is not None:
+            journal.record(cid, "open", f"{addr[0]}:{addr[1]}")
+        log.info(f"[+] Cliente conectado: {addr} (client_id={cid})")
 
+        try:
+            send_line(sess, "Etiqueta conectada al servidor.")
+        except Exception as e:
+            log.error(f"Error con {addr}: {e}")
+            close_client(cid)
+
+
+def _read_client(sess: Session, recv_view: memoryview):
+    # Solo el hilo del bucle toca last_seen y buffer: no hace falta lock
+    client_id = sess.cid
+    try:
+        n = sess.conn.recv_into(recv_view)
+    except (BlockingIOError, InterruptedError):
+        return
     except Exception as e:
-        print(f"[{now_ts()}] [!] Error con {addr}: {e}")
-    finally:
+        log.error(f"Error con {sess.addr}: {e}")
+        close_client(client_id)
+        return
+
+    if not n:
+        close_client(client_id)
+        return
+
+    sess.last_seen = time.time()
+
+    # Framing lineal: lo que ya había en el buffer no tiene '\n', así que solo
+    # se busca en lo nuevo, y el prefijo consumido se borra una única vez.
+    buf = sess.buffer
+    scan_from = len(buf)
+    buf += recv_view[:n]
+
+    start = 0
+    while True:
+        nl = buf.find(b"\n", scan_from)
+        if nl == -1:
+            break
+        if nl - start > MAX_LINE_BYTES:
+            log.warning(f"Línea de {nl - start} bytes (máx. {MAX_LINE_BYTES}) desde {sess.addr}: se desconecta")
+            close_client(client_id)
+            return
+        msg = buf[start:nl].decode("utf-8", errors="ignore").strip()
+        start = scan_from = nl + 1
+        if msg:
+            if journal is not None:
+                journal.record(client_id, "in", msg)
+            try:
+                process_message(client_id, msg)
+            except Exception as e:
+                log.error(f"Error procesando '{msg}': {e}")
+
+    if start:
+        del buf[:start]
+
+    if len(buf) > MAX_LINE_BYTES:
+        log.warning(f"Línea de más de {MAX_LINE_BYTES} bytes sin fin desde {sess.addr}: se desconecta")
+        close_client(client_id)
+
+
+def close_client(client_id: int):
+    # El selector solo se toca desde el bucle
+    if not in_loop_thread():
+        call_in_loop(close_client, client_id)
+        return
+
+    sess = clients.remove(client_id)
+    if not sess:
+        return
+    with sess.out_lock:
+        sess.closed = True
+        sess.out.clear()
+
+    registry.park(sess.addr[0], unindex_tag(client_id))
+    scan_dedupe.forget_reader(client_id)
+    if journal is not None:
+        journal.record(client_id, "close", "")
+
+    conn = sess.conn
+    try:
+        selector.unregister(conn)
+    except Exception:
+        pass
+    try:
+        conn.close()
+    except:
+        pass
+    log.info(f"[-] Cliente desconectado: {sess.addr} (client_id={client_id})")
+
+
+# ------------------ Vivacidad (last_seen) ------------------
+
+class LivenessManager:
+    """
+    Barrido de vivacidad con un heap de vencimientos (una entrada por sesión).
+    Al vencer se mira last_seen: si el cliente habló hace poco se reprograma;
+    si lleva IDLE_PROBE_S callado se le manda un PING de sondeo (cualquier
+    respuesta actualiza last_seen), y si tampoco contesta en PROBE_TIMEOUT_S
+    se desconecta. Los clientes activos no reciben tráfico extra.
+    """
+
+    def __init__(self):
+        self._cv = threading.Condition()
+        self._heap = []  # (vencimiento, cid)
+        self._thread = None
+        self.probes = 0
+        self.evicted = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def track(self, sess: Session):
+        self._push(sess.last_seen + IDLE_PROBE_S, sess.cid)
+
+    def _push(self, when: float, cid: int):
+        with self._cv:
+            heapq.heappush(self._heap, (when, cid))
+            if self._heap[0][1] == cid:
+                self._cv.notify()
+
+    def _run(self):
+        while True:
+            with self._cv:
+                while True:
+                    now = time.time()
+                    if self._heap and self._heap[0][0] <= now:
+                        _, cid = heapq.heappop(self._heap)
+                        break
+                    self._cv.wait(timeout=(self._heap[0][0] - now) if self._heap else None)
+            self._check(cid, now)
+
+    def _check(self, cid: int, now: float):
+        sess = clients.get(cid)
+        if sess is None:
+            return  # ya desconectado: la entrada se descarta
+
+        if sess.probe_sent:
+            if sess.last_seen >= sess.probe_sent:
+                sess.probe_sent = 0.0  # contestó
+            elif now - sess.probe_sent >= PROBE_TIMEOUT_S:
+                self.evicted += 1
+                log.warning(f"{sess.addr} no responde al sondeo: se desconecta (client_id={cid})")
+                close_client(cid)
+                return
+            else:
+                self._push(sess.probe_sent + PROBE_TIMEOUT_S, cid)
+                return
+
+        idle_until = sess.last_seen + IDLE_PROBE_S
+        if idle_until > now:
+            self._push(idle_until, cid)
+            return
+
+        sess.probe_sent = now
+        self.probes += 1
         try:
-            conn.close()
-        except:
+            send_line(sess, f"PING {PROBE_RID_PREFIX}{new_rid()}", kind="probe")
+        except Exception:
             pass
-        with clients_lock:
-            if client_id in clients:
-                del clients[client_id]
-        print(f"[{now_ts()}] [-] Cliente desconectado: {addr} (client_id={client_id})")
+        self._push(now + PROBE_TIMEOUT_S, cid)
 
 
-def process_message(client_id: int, msg: str):
-    with clients_lock:
-        addr = clients[client_id]["addr"] if client_id in clients else ("?", 0)
+liveness = LivenessManager()
 
-    print(f"[{now_ts()}] [{addr}] {msg}")
 
+# ------------------ Comandos recibidos ------------------
+# Cada handler recibe (client_id, sess, addr, args), con args = el resto de
+# la línea tras el comando. process_message despacha por la primera palabra.
+
+def _on_role(client_id, sess, addr, args):
     # ROLE NFC BOX / ROLE NFC DOOR
-    if msg.startswith("ROLE "):
-        parts = msg.split()
-        # ROLE NFC BOX
-        if len(parts) >= 3 and parts[1] == "NFC":
-            nfc_role = parts[2].upper()
-            with clients_lock:
-                if client_id in clients:
-                    clients[client_id]["role"] = "NFC"
-                    clients[client_id]["nfc_role"] = nfc_role
-            print(f"[{now_ts()}] [i] Cliente {client_id} registrado como NFC {nfc_role}")
-        return
+    parts = args.split()
+    if len(parts) >= 2 and parts[0] == "NFC":
+        nfc_role = parts[1].upper()
+        if sess:
+            sess.role = "NFC"
+            sess.nfc_role = nfc_role
+        log.info(f"[i] Cliente {client_id} registrado como NFC {nfc_role}")
+
 
+def _on_uid(client_id, sess, addr, args):
     # UID <rid> <HEXUID>
-    if msg.startswith("UID "):
-        parts = msg.split()
-        if len(parts) >= 3:
-            rid = parts[1].strip()
-            hexuid = parts[2].strip().upper()
-            with uid_cv:
-                uid_responses[rid] = {"cid": client_id, "uid": hexuid}
-                uid_cv.notify_all()
+    parts = args.split()
+    if len(parts) >= 2:
+        correlator.dispatch(("UID", parts[0]), client_id, parts[1].upper())
+
+
+def _on_pong(client_id, sess, addr, args):
+    # PONG <rid> EMPTY | PONG <rid> DATA {json} | PONG <rid> NFC <rol>
+    parts = args.split(" ", 2)
+    if len(parts) < 2:
+        return
+    rid = parts[0].strip()
+    status = parts[1].strip()
+    rest = parts[2].strip() if len(parts) == 3 else ""
+
+    # El JSON se decodifica aquí una vez; el índice y quien espera comparten el TagRecord
+    tag = None
+    if status == "DATA" and rest:
+        tag = TagRecord.from_json(rest)
+        if tag is not None:
+            index_tag(client_id, tag)
+    elif status == "EMPTY":
+        mark_empty(client_id)
+
+    # Respuesta a un sondeo de vivacidad: ya actualizó last_seen y el índice
+    if rid.startswith(PROBE_RID_PREFIX):
+        metrics.inc("pong.probe")
         return
 
+    # Si nadie espera ese rid (PONG tardío) se descarta sin guardarlo
+    w = correlator.dispatch(("PING", rid), client_id, {"status": status, "tag": tag})
+    if w is None:
+        metrics.inc("pong.late")
+    else:
+        metrics.observe("pong.rtt", time.monotonic() - w.sent_at)
+
 
-    # ----- PING/PONG -----
-    if msg.startswith("PONG "):
-        parts = msg.split(" ", 3)  # PONG rid STATUS [rest]
-        if len(parts) >= 3:
-            rid = parts[1].strip()
-            status = parts[2].strip()
-            rest = parts[3].strip() if len(parts) == 4 else ""
-
-            data_json = None
-            if status == "DATA" and rest:
-                data_json = rest
-
-            with ping_cv:
-                ping_responses.setdefault(rid, {})
-                ping_responses[rid][client_id] = {
-                    "status": status,
-                    "data": data_json,
-                    "raw": msg
-                }
-                ping_cv.notify_all()
+def _on_ack(client_id, sess, addr, args):
+    # Esperado: "ACK ID=3"
+    ack_id = None
+    try:
+        i = args.find("ID=")
+        if i != -1:
+            ack_id = int(args[i+3:].strip())
+    except:
+        ack_id = None
+
+    with tags_lock:
+        sent = pending_sets.pop(client_id, None)
+    if sent is not None and ack_id is not None and sent[0].id == ack_id:
+        index_tag(client_id, sent[0])
+        metrics.observe("set.ack", time.monotonic() - sent[1])
+
+    correlator.dispatch(("ACK", client_id), client_id, ack_id)
+
+
+def _on_reset(client_id, sess, addr, args):
+    # La etiqueta se ha vaciado (venta o botón)
+    mark_empty(client_id)
+
+
+def _on_move(client_id, sess, addr, args):
+    payload = args.strip()
+    try:
+        d = json_loads(payload)
+        if d.get("To"):
+            update_indexed_tag(client_id, ubicacion=str(d.get("To")).strip())
+        if not append_csv(
+            MOV_CSV,
+            headers=MOV_HEADERS,
+            row={
+                "timestamp": now_iso(),
+                "ip": addr[0],
+                "id": d.get("ID", ""),
+                "temporada": d.get("Temporada", ""),
+                "tipo": d.get("Tipo", ""),
+                "from": d.get("From", ""),
+                "to": d.get("To", ""),
+                "precio": d.get("Precio", ""),
+                "uid": indexed_uid(client_id),
+            }
+        ):
+            log.warning(f"Cola CSV llena: MOVE no registrado: {payload}")
+    except Exception as e:
+        log.warning(f"MOVE mal formado: {e}")
+
+
+def _on_sold(client_id, sess, addr, args):
+    payload = args.strip()
+    try:
+        d = json_loads(payload)
+        uid = indexed_uid(client_id)
+        mark_empty(client_id)
+        # Libro de ventas: con la cola llena va al búfer de desbordamiento, no se pierde
+        append_csv(
+            VEN_CSV,
+            headers=VEN_HEADERS,
+            row={
+                "timestamp": now_iso(),
+                "ip": addr[0],
+                "id": d.get("ID", ""),
+                "temporada": d.get("Temporada", ""),
+                "tipo": d.get("Tipo", ""),
+                "precio": d.get("Precio", ""),
+                "uid": uid,
+            },
+            durable=True,
+        )
+    except Exception as e:
+        log.warning(f"SOLD mal formado: {e}")
+
+
+def _on_scan(client_id, sess, addr, args):
+    # SCAN <HEXUID> desde un lector NFC (caja o puerta)
+    hexuid = args.strip().upper()
+
+    role = sess.role if sess else "TAG"
+    nfc_role = sess.nfc_role if sess else ""
+
+    # El SCAN espera PONGs que lee el propio bucle: nunca bloquearlo aquí.
+    # Va al ejecutor: primero caja, luego puerta; en orden por lector.
+    if role == "NFC" and nfc_role == "DOOR":
+        handler, prio = handle_scan_from_door, PRIO_DOOR
+    else:
+        handler, prio = handle_scan_from_box, PRIO_BOX
+
+    # Repetido del mismo lector y UID: responder ya, sin encolar nada
+    if resend_cached_scan(client_id, hexuid):
+        metrics.inc("scan.dedupe_hits")
         return
 
-    # ----- ACK -----
-    if msg.startswith("ACK"):
-        # Esperado: "ACK ID=3"
-        ack_id = None
-        try:
-            i = msg.find("ID=")
-            if i != -1:
-                ack_id = int(msg[i+3:].strip())
-        except:
-            ack_id = None
+    received_at = time.monotonic()
+    if scan_executor.submit(prio, ("SCAN", client_id), run_scan,
+                            handler, client_id, hexuid, received_at) is None:
+        metrics.inc("scan.busy")
+        log.warning(f"Cola de escaneos llena: BUSY a {addr} (UID={hexuid})")
+        try:
+            send_line(sess, f"BUSY {hexuid}")
+        except Exception:
+            pass
+
+
+COMMANDS = {
+    "ROLE": _on_role,
+    "UID": _on_uid,
+    "PONG": _on_pong,
+    "ACK": _on_ack,
+    "RESET": _on_reset,
+    "MOVE": _on_move,
+    "SOLD": _on_sold,
+    "SCAN": _on_scan,
+}
+
+
+def process_message(client_id: int, msg: str):
+    metrics.mark("lines.in")
+    sess = clients.get(client_id)
+    addr = sess.addr if sess else ("?", 0)
+    cmd, _, args = msg.partition(" ")
+
+    if log.isEnabledFor(logging.DEBUG) and log_line_sampled(cmd):
+        log.debug("[%s] %s", addr, msg)
 
-        with ack_cv:
-            ack_responses[client_id] = ack_id
-            ack_cv.notify_all()
-        return
+    handler = COMMANDS.get(cmd)
+    if handler is not None:
+        handler(client_id, sess, addr, args)
 
 
-    # ----- RESET -----
-    if msg.startswith("RESET"):
-        return
+def event_loop_thread():
+    """
+    Bucle único (selectors) que acepta conexiones y lee de todos los clientes.
+    Sustituye al antiguo hilo por conexión: miles de etiquetas en reposo solo
+    cuestan un descriptor y su Session en `clients`.
+    """
+    _raise_nofile_limit()
+
+    srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    srv.bind((HOST, PORT))
+    srv.listen(LISTEN_BACKLOG)
+    srv.setblocking(False)
+    global _loop_thread_id
+    _loop_thread_id = threading.get_ident()
+
+    selector.register(srv, selectors.EVENT_READ, None)
+    selector.register(_wake_r, selectors.EVENT_READ, _WAKE)
+    print(f"[{now_ts()}] Servidor TCP escuchando en {HOST}:{PORT}")
 
-    # ----- Movimiento -----
-    if msg.startswith("MOVE "):
-        payload = msg[5:].strip()
-        try:
-            d = json.loads(payload)
-            append_csv(
-                MOV_CSV,
-                headers=["timestamp", "ip", "id", "temporada", "tipo", "from", "to", "precio"],
-                row={
-                    "timestamp": now_iso(),
-                    "ip": addr[0],
-                    "id": d.get("ID", ""),
-                    "temporada": d.get("Temporada", ""),
-                    "tipo": d.get("Tipo", ""),
-                    "from": d.get("From", ""),
-                    "to": d.get("To", ""),
-                    "precio": d.get("Precio", ""),
-                }
-            )
-        except Exception as e:
-            print(f"[{now_ts()}] [!] MOVE mal formado: {e}")
-        return
+    # Un único buffer de recepción reutilizado para todas las conexiones
+    recv_view = memoryview(bytearray(RECV_SIZE))
 
-    # ----- Venta -----
-    if msg.startswith("SOLD "):
-        payload = msg[5:].strip()
-        try:
-            d = json.loads(payload)
-            append_csv(
-                VEN_CSV,
-                headers=["timestamp", "ip", "id", "temporada", "tipo", "precio"],
-                row={
-                    "timestamp": now_iso(),
-                    "ip": addr[0],
-                    "id": d.get("ID", ""),
-                    "temporada": d.get("Temporada", ""),
-                    "tipo": d.get("Tipo", ""),
-                    "precio": d.get("Precio", ""),
-                }
-            )
-        except Exception as e:
-            print(f"[{now_ts()}] [!] SOLD mal formado: {e}")
-        return
+    while True:
+        for key, mask in selector.select():
+            data = key.data
+            if data is None:
+                _accept_clients(key.fileobj)
+            elif data is _WAKE:
+                try:
+                    while _wake_r.recv(4096):
+                        pass
+                except (BlockingIOError, InterruptedError):
+                    pass
+            else:
+                if mask & selectors.EVENT_WRITE:
+                    _flush_out(data)
+                if mask & selectors.EVENT_READ and not data.closed:
+                    _read_client(data, recv_view)
+        _run_loop_calls()
+
+
+# ------------------ Captura y reproducción de tráfico ------------------
+
+# Diario JSONL: una cabecera y después [t, cid, tipo, línea] por registro, con
+# t en segundos monotónicos desde el inicio de la captura. Tipos: "open" (la
+# línea es ip:puerto), "in", "out", "probe" (PING de vivacidad) y "close".
+JOURNAL_VERSION = 1
+JOURNAL_BUFFER_BYTES = 1 << 20
+JOURNAL_FLUSH_S = 1.0
+REPLAY_DRAIN_S = 10.0    # espera máxima a los escaneos pendientes al acabar el diario
+
+
+class TrafficJournal:
+    """Escritura del diario de captura; la llaman el bucle y los hilos de escaneo."""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._f = open(filename, "w", encoding="utf-8", buffering=JOURNAL_BUFFER_BYTES)
+        self._t0 = time.monotonic()
+        self._last_flush = self._t0
+        self.records = 0
+        self._f.write(json.dumps({"journal": JOURNAL_VERSION, "inicio": now_iso()}) + "\n")
+
+    def record(self, cid: int, kind: str, line: str):
+        now = time.monotonic()
+        rec = json_dumps([round(now - self._t0, 6), cid, kind, line])
+        with self._lock:
+            if self._f is None:
+                return
+            self._f.write(rec + "\n")
+            self.records += 1
+            if now - self._last_flush >= JOURNAL_FLUSH_S:
+                self._f.flush()
+                self._last_flush = now
+
+    def close(self):
+        with self._lock:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+
+
+journal = None  # TrafficJournal con --capture
+
+
+def read_journal(filename: str):
+    with open(filename, encoding="utf-8") as f:
+        header = json.loads(f.readline())
+        if header.get("journal") != JOURNAL_VERSION:
+            raise ValueError(f"{filename}: versión de diario no soportada ({header.get('journal')})")
+        return header, [json_loads(line) for line in f if line.strip()]
+
+
+class _ReplayConn:
+    """Socket falso de una sesión reproducida: todo envío cabe y se le enseña al driver."""
+
+    def __init__(self, driver, rec_cid: int):
+        self.driver = driver
+        self.rec_cid = rec_cid
+
+    def send(self, data) -> int:
+        self.driver.on_out(self.rec_cid, data)
+        return len(data)
+
+    def close(self):
+        pass
 
-    # ----- SCAN desde NFC (caja) -----
-    # Formato: SCAN <HEXUID>
-    if msg.startswith("SCAN "):
-        hexuid = msg[5:].strip().upper()
 
-        # Solo aceptar SCAN si este cliente es NFC BOX
-        with clients_lock:
-            role = clients.get(client_id, {}).get("role", "TAG")
-            nfc_role = clients.get(client_id, {}).get("nfc_role", "")
+class JournalReplayer:
+    """
+    Reproduce un diario a través de process_message, sin red. El hilo que
+    reproduce hace de hilo del bucle (recibe las líneas y ejecuta las tareas
+    de call_in_loop); los escaneos, el ejecutor, la correlación y los CSV son
+    los de verdad, así que sirve para perfilar y comparar versiones.
+
+    Las líneas espontáneas (ROLE, SCAN, MOVE, SOLD, ACK...) se entregan en su
+    instante grabado. Los PONG y UID no: sus rid dependen de lo que decida el
+    servidor en esta ejecución, así que cada PING/READUID que salga ahora se
+    contesta con el estado grabado de ese dispositivo en ese instante y con
+    el tiempo de respuesta que tuvo en la captura. Un dispositivo que nunca
+    contestó tampoco contesta ahora.
+    """
 
-        if role == "NFC" and nfc_role == "BOX":
-            handle_scan_from_box(client_id, hexuid)
-            return
-        
-        if role == "NFC" and nfc_role == "DOOR":
-            handle_scan_from_door(client_id, hexuid)
+    def __init__(self, records, speed: float = 1.0):
+        self.records = records
+        self.speed = speed
+        self._lock = threading.Lock()
+        self._live = {}       # cid grabado -> Session
+        self._pongs = {}      # cid grabado -> ([t], [(rtt, cuerpo)]) de sus PONG grabados
+        self._uids = {}       # cid grabado -> deque de (rtt, uid) de sus UID grabados
+        self._due = []        # heap de (monotonic, seq, cid grabado, línea) por entregar
+        self._seq = itertools.count()
+        self._t = 0.0         # instante del diario por el que va la reproducción
+        self.delivered = 0
+        self.answered = 0
+
+        sent = {}
+        for t, cid, kind, line in records:
+            if kind in ("out", "probe") and line.startswith(("PING ", "READUID ")):
+                sent[(cid, line.split(" ", 1)[1].strip())] = t
+            elif kind == "in" and line.startswith(("PONG ", "UID ")):
+                parts = line.split(" ", 2)
+                if len(parts) < 3:
+                    continue
+                rtt = max(0.0, t - sent.get((cid, parts[1]), t))
+                if parts[0] == "PONG":
+                    ts, bodies = self._pongs.setdefault(cid, ([], []))
+                    ts.append(t)
+                    bodies.append((rtt, parts[2]))
+                else:
+                    self._uids.setdefault(cid, deque()).append((rtt, parts[2]))
+
+    def on_out(self, rec_cid: int, data):
+        line = bytes(data).decode("utf-8", errors="ignore").strip()
+        if line.startswith("PING "):
+            pongs = self._pongs.get(rec_cid)
+            if not pongs:
+                return
+            # Estado del dispositivo: su último PONG grabado hasta ahora (o el primero)
+            i = max(0, bisect.bisect_right(pongs[0], self._t) - 1)
+            rtt, body = pongs[1][i]
+            reply = f"PONG {line[5:].strip()} {body}"
+        elif line.startswith("READUID "):
+            with self._lock:
+                uids = self._uids.get(rec_cid)
+                if not uids:
+                    return
+                rtt, uid = uids.popleft()
+            reply = f"UID {line[8:].strip()} {uid}"
+        else:
             return
+        due = time.monotonic() + (rtt / self.speed if self.speed > 0 else 0.0)
+        with self._lock:
+            heapq.heappush(self._due, (due, next(self._seq), rec_cid, reply))
+
+    def _session(self, rec_cid: int, addr: str = "replay:0") -> Session:
+        sess = self._live.get(rec_cid)
+        if sess is None:
+            host, _, port = addr.rpartition(":")
+            sess = clients.add(_ReplayConn(self, rec_cid), (host, int(port or 0)))
+            self._live[rec_cid] = sess
+        return sess
+
+    def _deliver(self, rec_cid: int, line: str):
+        sess = self._session(rec_cid)
+        sess.last_seen = time.time()
+        try:
+            process_message(sess.cid, line)
+        except Exception as e:
+            log.error(f"Error procesando '{line}': {e}")
+        self.delivered += 1
 
-        handle_scan_from_box(client_id, hexuid)
-        return
+    def _deliver_due(self):
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                if not self._due or self._due[0][0] > now:
+                    break
+                _, _, rec_cid, line = heapq.heappop(self._due)
+            if rec_cid in self._live:
+                self._deliver(rec_cid, line)
+                self.answered += 1
+        _run_loop_calls()
+
+    def _idle(self, seconds: float):
+        # Mientras se espera al siguiente registro se siguen contestando PING
+        end = time.monotonic() + seconds
+        while True:
+            self._deliver_due()
+            left = end - time.monotonic()
+            if left <= 0:
+                return
+            time.sleep(min(left, 0.001))
+
+    def run(self):
+        global _loop_thread_id
+        _loop_thread_id = threading.get_ident()
+
+        t_start = time.monotonic()
+        for t, rec_cid, kind, line in self.records:
+            if self.speed > 0:
+                delay = t / self.speed - (time.monotonic() - t_start)
+                if delay > 0:
+                    self._idle(delay)
+            self._t = t
+
+            if kind == "open":
+                self._session(rec_cid, line)
+            elif kind == "close":
+                sess = self._live.pop(rec_cid, None)
+                if sess is not None:
+                    close_client(sess.cid)
+            elif kind == "in" and not line.startswith(("PONG ", "UID ")):
+                if line.startswith("SCAN ") and self.speed <= 0:
+                    # A toda velocidad no se desborda la cola: un lector real no iría más rápido
+                    while scan_executor.pending() >= SCAN_QUEUE_MAX:
+                        self._idle(0.001)
+                self._deliver(rec_cid, line)
+            self._deliver_due()
+
+        # Que terminen los escaneos en curso antes de medir (sin esperar indefinidamente)
+        drain_until = time.monotonic() + REPLAY_DRAIN_S
+        while (self._due or scan_executor.pending()) and time.monotonic() < drain_until:
+            self._idle(0.01)
+        return time.monotonic() - t_start
+
+
+def replay_journal(filename: str, speed: float):
+    header, records = read_journal(filename)
+    print(f"[{now_ts()}] Reproduciendo {filename} ({len(records)} registros, capturado {header.get('inicio')}, "
+          f"velocidad {'máxima' if speed <= 0 else f'{speed:g}x'})")
+    player = JournalReplayer(records, speed)
+    elapsed = player.run()
+    csv_writer.flush()
+    print(f"[{now_ts()}] Reproducidas {player.delivered} líneas en {elapsed:.2f}s "
+          f"({player.delivered / elapsed if elapsed else 0:.0f} líneas/s), {player.answered} respuestas "
+          f"regeneradas, escaneos sin terminar: {scan_executor.pending()}")
+    print(metrics.render_text(), end="")
 
-    return
 
+# ------------------ POLLING GLOBAL (la clave del refactor) ------------------
 
-def acceptor_thread():
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s.bind((HOST, PORT))
-    s.listen(20)
-    print(f"[{now_ts()}] Servidor TCP escuchando en {HOST}:{PORT}")
+def new_rid() -> str:
+    # Único en el proceso (time.time()*1000 colisiona si dos polls arrancan en el mismo ms)
+    return str(next(_rid_seq))
 
-    client_id_counter = 1
-    while True:
-        conn, addr = s.accept()
-        with clients_lock:
-            cid = client_id_counter
-            client_id_counter += 1
-            clients[cid] = {
-                "conn": conn,
-                "addr": addr,
-                "configured": False,  # ya NO es fuente de verdad
-                "last_seen": time.time(),
-                "buffer": b"",
-                "tag_data": None,
-                "role": "TAG", # Por defecto NFC por el contrario
-                "nfc_role": None # Caja / Puerta
-            }
-        t = threading.Thread(target=handle_client, args=(cid,), daemon=True)
-        t.start()
 
+def _join_flight(cids, timeout_s: float):
+    """
+    Single-flight: si hay un broadcast en curso que empezó hace menos de
+    COALESCE_WINDOW_S y cubre los cids pedidos, se reutiliza; si no, se crea
+    uno nuevo. Devuelve (flight, es_nuevo).
+    """
+    global current_flight
+
+    now = time.time()
+    with flight_lock:
+        f = current_flight
+        if f and now - f["started"] <= COALESCE_WINDOW_S:
+            if cids is None or set(cids) <= f["expected"]:
+                f["users"] += 1
+                f["waiter"].extend(timeout_s + WAITER_GRACE_S)
+                return f, False
+
+        # Solo clientes vivos: ni lentos (cola de salida llena) ni callados
+        # ante un sondeo de vivacidad; a esos no se les espera.
+        snapshot = [(cid, sess) for cid, sess in clients.snapshot(cids) if sess.is_live(now)]
+
+        if not snapshot:
+            return None, False
+
+        rid = new_rid()
+        f = {
+            "rid": rid,
+            "waiter": correlator.register(("PING", rid), timeout_s + WAITER_GRACE_S),
+            "snapshot": snapshot,
+            "expected": {cid for cid, _ in snapshot},
+            "started": now,
+            "users": 1,
+            "judged": set(),  # cids cuya espera llegó a veredicto
+            "missed": set(),  # cids sin PONG al vencer el plazo
+        }
+
+        # Solo los broadcasts completos se comparten
+        if cids is None:
+            current_flight = f
+        return f, True
+
+
+def _leave_flight(f):
+    global current_flight
+
+    with flight_lock:
+        f["users"] -= 1
+        if f["users"] > 0:
+            return
+        if current_flight is f:
+            current_flight = None
+    correlator.unregister(f["waiter"])
 
-# ------------------ POLLING GLOBAL (la clave del refactor) ------------------
+    # Solo cuentan las esperas con veredicto (todas llegaron o venció el plazo);
+    # las que salen antes por match/limit no esperaron al resto.
+    w = f["waiter"]
+    with w.cv:
+        missed = f["missed"].difference(w.responses)
+    metrics.inc("pong.expected", len(f["judged"]))
+    metrics.inc("pong.missed", len(missed))
+    metrics.observe("poll.duration", time.monotonic() - w.sent_at)
 
-def poll_tags(timeout_s: float = 3.0):
+
+def poll_tags(timeout_s: float = 3.0, cids=None, match=None, limit=None):
     """
-    Hace un 'broadcast lógico' PING a todos los conectados y devuelve:
+    Hace un 'broadcast lógico' PING a todos los conectados (o solo a `cids`)
+    y devuelve:
       - snapshot: lista de (cid, info) en el momento del ping
-      - resp: dict cid -> {status, data, raw} con respuestas recibidas
+      - resp: dict cid -> {status, tag} con respuestas recibidas (tag: TagRecord o None)
       - rid: request id
+
+    Si se pasa `match(cid, r) -> bool`, las respuestas se evalúan según llegan
+    y se vuelve en cuanto hay `limit` coincidencias (1 por defecto), sin
+    esperar a las etiquetas lentas o desconectadas.
+
+    Las llamadas concurrentes se agrupan en un único PING compartido
+    (ver _join_flight).
     """
-    with clients_lock:
-        snapshot = list(clients.items())
+    if match is not None and limit is None:
+        limit = 1
 
-    if not snapshot:
+    f, is_new = _join_flight(cids, timeout_s)
+    if f is None:
         return [], {}, None
+    metrics.inc("poll.calls")
+    if not is_new:
+        metrics.inc("poll.coalesced")
 
-    rid = str(int(time.time() * 1000))
+    rid = f["rid"]
+    if cids is None:
+        snapshot = f["snapshot"]
+    else:
+        wanted = set(cids)
+        snapshot = [(cid, info) for cid, info in f["snapshot"] if cid in wanted]
     expected = {cid for cid, _ in snapshot}
 
-    with ping_cv:
-        ping_responses[rid] = {}
+    try:
+        # enviar PING (solo quien abre el vuelo)
+        if is_new:
+            for cid, info in f["snapshot"]:
+                try:
+                    send_line(info, f"PING {rid}")
+                except:
+                    pass
+
+        # Solo se evalúan las respuestas nuevas en cada despertar
+        pos = got = matches = 0
+
+        def ready(w):
+            nonlocal pos, got, matches
+            while pos < len(w.arrivals):
+                cid = w.arrivals[pos]
+                pos += 1
+                if cid not in expected:
+                    continue
+                got += 1
+                if match is not None and match(cid, w.responses[cid]):
+                    matches += 1
+            if got >= len(expected):
+                return True
+            return match is not None and matches >= limit
+
+        w = f["waiter"]
+        completed = w.wait_until(ready, timeout_s)
+        with w.cv:
+            resp = {cid: r for cid, r in w.responses.items() if cid in expected}
+        if not completed:
+            with flight_lock:
+                f["judged"] |= expected
+                f["missed"] |= expected - resp.keys()
+        elif len(resp) >= len(expected):
+            with flight_lock:
+                f["judged"] |= expected
+    finally:
+        _leave_flight(f)
+
+    return snapshot, resp, rid
+
+
+# ------------------ Reconciliación en segundo plano ------------------
+
+RECON_MAX_STALENESS_S = 30.0  # cota de edad de la caché; 0 = reconciliación desactivada
+RECON_TICK_S = 0.25           # cada tick sondea una partición, repartida dentro del tick
+RECON_PONG_TIMEOUT_S = 2.0    # PONG no recibido en este tiempo => cuenta como perdido
+RECON_MIN_RATE = 2.0          # PINGs/s: suelo del control de pérdidas
+RECON_MAX_RATE = 100.0        # PINGs/s: techo de airtime dedicado a reconciliar
+RECON_RATE_STEP = 2.0         # subida aditiva por ajuste sin pérdidas
+RECON_LOSS_HIGH = 0.05        # pérdida (media móvil) a partir de la que se frena
+RECON_LOSS_LOW = 0.01         # por debajo de esto se vuelve a acelerar
+RECON_ADJUST_S = 1.0          # como mucho un ajuste de tasa por segundo
 
-    # enviar PING
-    for cid, info in snapshot:
-        try:
-            send_line(info["conn"], f"PING {rid}")
-        except:
-            pass
 
-    deadline = time.time() + timeout_s
-    with ping_cv:
+class Reconciler:
+    """
+    Mantiene tag_index fresco sin broadcasts: en cada tick toma la partición
+    de etiquetas con el contacto más antiguo (PONG, ACK, MOVE... o el último
+    intento) y les manda un PING a cada una en un instante aleatorio dentro
+    del tick, así la flota rota entera sin que dos etiquetas contesten a la vez.
+
+    Cada etiqueta se re-sondea cuando su dato llega a la mitad de la cota, para
+    que un PONG perdido aún pueda reintentarse a tiempo. La tasa es constante
+    (tamaño de flota / periodo) y está limitada por un techo AIMD que baja a la
+    mitad cuando sube la pérdida de PONGs y crece poco a poco cuando no la hay.
+    Una etiqueta que falla dos veces seguidas está caída, no congestionada:
+    solo su primer fallo cuenta como pérdida.
+    """
+
+    def __init__(self, max_staleness_s: float = RECON_MAX_STALENESS_S):
+        self.max_staleness_s = max_staleness_s
+        self.rate_limit = RECON_MAX_RATE
+        self.rate = 0.0
+        self.loss = 0.0           # media móvil de la fracción de PONGs perdidos
+        self._attempted = {}      # cid -> último PING de reconciliación
+        self._batches = deque()   # (vence, waiter, cids sondeados) pendientes de evaluar
+        self._missed = set()      # cids que no contestaron a su último PING
+        self._budget = 0.0
+        self._next_adjust = 0.0
+        self._thread = None
+
+    def start(self):
+        if self._thread is None and self.max_staleness_s > 0:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        next_tick = time.time()
         while True:
-            got = set(ping_responses.get(rid, {}).keys())
-            if got >= expected:
-                break
+            next_tick += RECON_TICK_S
+            try:
+                self._tick(next_tick)
+            except Exception as e:
+                log.error(f"Reconciliación: {e}")
+            delay = next_tick - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_tick = time.time()  # atrasado: no recuperar ticks perdidos a ráfagas
+
+    def _tick(self, tick_end: float):
+        now = time.time()
+        self._collect(now)
+
+        # Un broadcast en curso ya refresca a toda la flota
+        if current_flight is not None:
+            return
 
-            remaining = deadline - time.time()
-            if remaining <= 0:
-                break
+        refresh_age = self.max_staleness_s / 2
+        candidates = []
+        live = 0
+        for cid, sess in clients.snapshot():
+            if sess.role == "NFC" or not sess.is_live(now) or cid in quarantined_tags:
+                continue
+            live += 1
+            entry = tag_index.get(cid)
+            seen = max(entry["ts"] if entry else 0.0, self._attempted.get(cid, 0.0))
+            if now - seen >= refresh_age:
+                candidates.append((seen, cid, sess))
+
+        if len(self._attempted) > 2 * live + 64:
+            alive = {cid for cid, _ in clients.snapshot()}
+            self._attempted = {cid: t for cid, t in self._attempted.items() if cid in alive}
+
+        # Tasa fija para recorrer la flota en refresh_age, sin pasar del techo
+        self.rate = max(RECON_MIN_RATE, min(self.rate_limit, live / refresh_age))
+        self._budget = min(self._budget + self.rate * RECON_TICK_S, self.rate)
+        k = min(int(self._budget), len(candidates))
+        if k <= 0:
+            return
+        self._budget -= k
+        part = heapq.nsmallest(k, candidates, key=lambda x: x[0])
+
+        rid = new_rid()
+        w = correlator.register(("PING", rid), RECON_PONG_TIMEOUT_S + WAITER_GRACE_S)
+        offsets = sorted(random.uniform(0, RECON_TICK_S) for _ in part)
+        sent = set()
+        for (_, cid, sess), off in zip(part, offsets):
+            delay = (tick_end - RECON_TICK_S + off) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self._attempted[cid] = time.time()
+            try:
+                send_line(sess, f"PING {rid}", kind="probe")
+                sent.add(cid)
+            except Exception:
+                pass
+        metrics.inc("recon.pings", len(sent))
+        self._batches.append((time.time() + RECON_PONG_TIMEOUT_S, w, sent))
+
+    def _collect(self, now: float):
+        """Cierra las tandas vencidas y ajusta la tasa según la pérdida observada."""
+        while self._batches and self._batches[0][0] <= now:
+            _, w, sent = self._batches.popleft()
+            correlator.unregister(w)
+            if not sent:
+                continue
+            with w.cv:
+                lost = sent.difference(w.responses)
+            fresh = lost - self._missed
+            self._missed = (self._missed - sent) | lost
+            metrics.inc("recon.lost", len(lost))
+            self.loss += 0.2 * (len(fresh) / len(sent) - self.loss)
+
+        if now < self._next_adjust:
+            return
+        self._next_adjust = now + RECON_ADJUST_S
+        if self.loss > RECON_LOSS_HIGH:
+            self.rate_limit = max(RECON_MIN_RATE, self.rate_limit / 2)
+        elif self.loss < RECON_LOSS_LOW:
+            self.rate_limit = min(RECON_MAX_RATE, self.rate_limit + RECON_RATE_STEP)
 
-            ping_cv.wait(timeout=remaining)
 
-        resp = ping_responses.get(rid, {})
-        ping_responses.pop(rid, None)
+reconciler = Reconciler()
 
-    return snapshot, resp, rid
 
 # --------- Leer NFC de CAJA -----
 def get_nfc_reader(role_name: str):
     role_name = role_name.upper()
-    with clients_lock:
-        for cid, info in clients.items():
-            if info.get("role") == "NFC" and info.get("nfc_role") == role_name:
-                return cid, info["conn"], info["addr"]
+    for cid, info in clients.snapshot():
+        if info.role == "NFC" and info.nfc_role == role_name:
+            return cid, info, info.addr
     return None, None, None
 
 # --------- Ver si el escaneo de CAJA es una prenda -----
 
+def _match_uid(r, uid_hex: str):
+    if not r or r["status"] != "DATA":
+        return None
+    tag = r["tag"]
+    if tag is None or tag.uid != uid_hex:
+        return None
+    return tag
+
+def find_tag_by_uid(uid_hex: str, timeout_s: float):
+    """
+    Busca la etiqueta con ese UID. Primero mira el índice y confirma con un
+    PING dirigido; solo si el índice falla hace el broadcast a toda la flota.
+    Devuelve (tag_cid, info, TagRecord) o None.
+    """
+    cid, _ = lookup_uid(uid_hex)
+    if cid is not None:
+        snapshot, resp, _ = poll_tags(timeout_s=min(timeout_s, VERIFY_TIMEOUT_S), cids=[cid])
+        d = _match_uid(resp.get(cid), uid_hex)
+        if d and snapshot:
+            return cid, snapshot[0][1], d
+
+    snapshot, resp, rid = poll_tags(
+        timeout_s=timeout_s,
+        match=lambda cid, r: cid not in quarantined_tags and _match_uid(r, uid_hex) is not None,
+    )
+    for cid, info in snapshot:
+        if cid in quarantined_tags:
+            continue
+        d = _match_uid(resp.get(cid), uid_hex)
+        if d:
+            return cid, info, d
+    return None
+
 def handle_scan_from_box(nfc_cid: int, uid_hex: str):
     """
-    Caja detecta UID -> el servidor hace poll_tags() -> busca etiqueta con UID
+    Caja detecta UID -> el servidor busca la etiqueta (índice o poll_tags())
     Si está en tienda: ordena venta (SELL) y responde con precio a la caja
     Si está en almacén: alerta de ROBO
     Si no existe: NO_MATCH
+    Devuelve la línea enviada a la caja (None si la caja ya no está).
     """
-    # 1) preguntar stock en vivo
-    snapshot, resp, rid = poll_tags(timeout_s=3.0)
-
-    # 2) buscar coincidencia por UID
-    match = None  # (tag_cid, data_dict)
-    for cid, info in snapshot:
-        # ignorar NFCs
-        with clients_lock:
-            if clients.get(cid, {}).get("role") == "NFC":
-                continue
-
-        r = resp.get(cid)
-        if not r or r.get("status") != "DATA":
-            continue
-
-        data_json = r.get("data") or "{}"
-        try:
-            d = json.loads(data_json)
-        except:
-            continue
-
-        tag_uid = str(d.get("UID", "")).strip().upper()
-        if tag_uid and tag_uid == uid_hex:
-            match = (cid, d)
-            break
+    # 1-2) buscar coincidencia por UID (índice + PING dirigido, o broadcast)
+    found = find_tag_by_uid(uid_hex, timeout_s=3.0)
+    match = (found[0], found[2]) if found else None  # (tag_cid, TagRecord)
 
     # 3) responder a la caja
-    with clients_lock:
-        if nfc_cid not in clients:
-            return
-        nfc_conn = clients[nfc_cid]["conn"]
+    nfc = clients.get(nfc_cid)
+    if not nfc:
+        return
 
     if not match:
+        reply = f"PAY NO_MATCH UID={uid_hex}"
         try:
-            send_line(nfc_conn, f"PAY NO_MATCH UID={uid_hex}")
+            send_line(nfc, reply)
         except:
             pass
-        return
+        return reply
 
     tag_cid, d = match
-    ubic = str(d.get("Ubicacion", "")).strip()
+    ubic = d.ubicacion
     ubic_l = ubic.lower()
-    precio = d.get("Precio", 0.0)
-    try:
-        precio_f = float(precio)
-    except:
-        precio_f = 0.0
+    precio_f = d.precio
 
-    tag_id = d.get("ID", "")
-    tipo = d.get("Tipo", "")
-    temporada = d.get("Temporada", "")
+    tag_id = "" if d.id is None else d.id
+    tipo = d.tipo
+    temporada = d.temporada
 
     # 4) si no está en tienda => “robo”
     if ubic_l != "tienda":
+        reply = f"PAY ALERT ROBO ID={tag_id} TIPO={tipo} TEMP={temporada} UBI={ubic} PRECIO={precio_f:.2f} UID={uid_hex}"
         try:
-            send_line(
-                nfc_conn,
-                f"PAY ALERT ROBO ID={tag_id} TIPO={tipo} TEMP={temporada} UBI={ubic} PRECIO={precio_f:.2f} UID={uid_hex}"
-            )
+            send_line(nfc, reply)
         except:
             pass
-        return
+        return reply
 
     # 5) está en tienda => OK, cobrar y ordenar venta
+    reply = f"PAY OK ID={tag_id} TIPO={tipo} TEMP={temporada} PRECIO={precio_f:.2f} UID={uid_hex}"
     try:
-        send_line(
-            nfc_conn,
-            f"PAY OK ID={tag_id} TIPO={tipo} TEMP={temporada} PRECIO={precio_f:.2f} UID={uid_hex}"
-        )
+        send_line(nfc, reply)
     except:
         pass
 
     # Ordenar a la etiqueta que se venda (ella enviará SOLD y luego se vacía)
-    with clients_lock:
-        tag_conn = clients.get(tag_cid, {}).get("conn")
-
-    if tag_conn:
+    tag = clients.get(tag_cid)
+    if tag:
         try:
-            send_line(tag_conn, "SELL")
+            send_line(tag, "SELL")
         except:
             pass
 
-# --------- Ver si el escaneo de PUERTA es una prenda -----
+    return reply
 
-def handle_scan_from_door(nfc_cid: int, uid_hex: str):
-    snapshot, resp, rid = poll_tags(timeout_s=2.0)
+# --------- Escaneos repetidos (antirrebote) -----
 
-    # 1) buscar etiqueta con ese UID
-    found = None  # (tag_cid, tag_info, data_dict)
-    for cid, info in snapshot:
-        # saltar NFCs
-        with clients_lock:
-            if clients.get(cid, {}).get("role") == "NFC":
-                continue
+SCAN_DEDUPE_WINDOW_S = 3.0  # mismo lector + mismo UID dentro de la ventana => repetido
+SCAN_DEDUPE_MAX = 1024      # entradas LRU
+# Solo se cachean los resultados definitivos: un NO_MATCH/NOTFOUND/ERROR puede
+# deberse a una etiqueta lenta, y el reintento del cajero debe volver a buscar.
+SCAN_DEDUPE_REPLIES = ("PAY OK ", "PAY ALERT ", "DOOR OK ")
 
-        r = resp.get(cid)
-        if not r or r.get("status") != "DATA":
-            continue
 
+class ScanDedupe:
+    """
+    Caché LRU (cid del lector, UID) -> última respuesta definitiva. Un SCAN
+    repetido dentro de la ventana recibe la misma respuesta sin PING ni SET.
+    La ventana cuenta desde la respuesta original: los repetidos no la alargan.
+    """
+
+    def __init__(self, window_s: float = SCAN_DEDUPE_WINDOW_S, max_entries: int = SCAN_DEDUPE_MAX):
+        self.window_s = window_s
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> [ts, reply]
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            e = self._entries.get(key)
+            if e is None:
+                return None
+            if now - e[0] > self.window_s:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return e[1]
+
+    def put(self, key, reply: str):
+        with self._lock:
+            self._entries[key] = [time.time(), reply]
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def forget_reader(self, nfc_cid: int):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == nfc_cid]:
+                del self._entries[key]
+
+
+scan_dedupe = ScanDedupe()
+
+
+def resend_cached_scan(nfc_cid: int, uid_hex: str) -> bool:
+    """Si el SCAN es un repetido reciente, reenvía la respuesta cacheada y devuelve True."""
+    reply = scan_dedupe.get((nfc_cid, uid_hex))
+    if reply is None:
+        return False
+    nfc = clients.get(nfc_cid)
+    if nfc:
         try:
-            d = json.loads(r.get("data") or "{}")
-        except:
-            continue
+            send_line(nfc, reply)
+        except Exception:
+            pass
+    return True
 
-        if str(d.get("UID", "")).strip().upper() == uid_hex:
-            found = (cid, info, d)
-            break
+
+def run_scan(handler, nfc_cid: int, uid_hex: str, received_at: float):
+    # Se vuelve a mirar aquí: el repetido pudo encolarse mientras el original se procesaba
+    if resend_cached_scan(nfc_cid, uid_hex):
+        metrics.inc("scan.dedupe_hits")
+        return
+    reply = handler(nfc_cid, uid_hex)
+    if reply:
+        if reply.startswith(SCAN_DEDUPE_REPLIES):
+            scan_dedupe.put((nfc_cid, uid_hex), reply)
+        # De SCAN recibido a respuesta enviada (incluye la cola del ejecutor)
+        kind = "box" if handler is handle_scan_from_box else "door"
+        metrics.observe(f"scan.{kind}", time.monotonic() - received_at)
+        metrics.inc(f"scan.{kind}.{reply.split()[1].lower()}")
+
+
+# --------- Ver si el escaneo de PUERTA es una prenda -----
+
+def handle_scan_from_door(nfc_cid: int, uid_hex: str):
+    # 1) buscar etiqueta con ese UID
+    found = find_tag_by_uid(uid_hex, timeout_s=2.0)  # (tag_cid, tag_info, TagRecord)
 
     # 2) obtener conexión del lector puerta (para responderle)
-    with clients_lock:
-        if nfc_cid not in clients:
-            return
-        nfc_conn = clients[nfc_cid]["conn"]
+    nfc = clients.get(nfc_cid)
+    if not nfc:
+        return
 
     # 3) si no existe esa UID
     if not found:
+        reply = f"DOOR NOTFOUND {uid_hex}"
         try:
-            send_line(nfc_conn, f"DOOR NOTFOUND {uid_hex}")
+            send_line(nfc, reply)
         except:
             pass
-        return
+        return reply
 
     # 4) si existe -> alternar ubicación
     tag_cid, tag_info, d = found
-    ubic = str(d.get("Ubicacion", "")).strip()
+    ubic = d.ubicacion
 
     if ubic == "Almacén":
         new_ubic = "Tienda"
     elif ubic == "Tienda":
         new_ubic = "Almacén"
     else:
+        reply = f"DOOR ERROR {uid_hex} UBIC={ubic}"
         try:
-            send_line(nfc_conn, f"DOOR ERROR {uid_hex} UBIC={ubic}")
+            send_line(nfc, reply)
         except:
             pass
-        return
+        return reply
 
     # 5) enviar SET completo a la etiqueta (solo cambia Ubicacion)
-    d2 = dict(d)
-    d2["Ubicacion"] = new_ubic
+    d2 = d.replace(ubicacion=new_ubic)
 
     try:
-        with clients_lock:
-            tag_conn = clients.get(tag_cid, {}).get("conn")
-        if tag_conn:
-            send_line(tag_conn, "SET " + json.dumps(d2, ensure_ascii=False))
+        tag = clients.get(tag_cid)
+        if tag:
+            send_set(tag_cid, tag, d2)
     except:
         pass
 
     # 6) log movimiento
     try:
-        append_csv(
+        if not append_csv(
             MOV_CSV,
-            headers=["timestamp", "ip", "id", "temporada", "tipo", "from", "to", "precio"],
+            headers=MOV_HEADERS,
             row={
                 "timestamp": now_iso(),
-                "ip": tag_info["addr"][0],
-                "id": d.get("ID", ""),
-                "temporada": d.get("Temporada", ""),
-                "tipo": d.get("Tipo", ""),
+                "ip": tag_info.addr[0],
+                "id": d.id,
+                "temporada": d.temporada,
+                "tipo": d.tipo,
                 "from": ubic,
                 "to": new_ubic,
-                "precio": d.get("Precio", ""),
+                "precio": d.precio,
+                "uid": uid_hex,
             }
-        )
+        ):
+            log.warning(f"Cola CSV llena: movimiento de puerta no registrado (UID={uid_hex})")
     except:
         pass
 
     # 7) responder al lector puerta
+    reply = f"DOOR OK {uid_hex} {ubic}->{new_ubic}"
     try:
-        send_line(nfc_conn, f"DOOR OK {uid_hex} {ubic}->{new_ubic}")
+        send_line(nfc, reply)
     except:
         pass
+    return reply
 
 
 # ------------------ Menú: alta ------------------
 
+TEMPORADAS = ("Invierno", "Verano")
+TIPOS = ("Gorra", "Camiseta", "Pantalones", "Calcetines")
+
+
 def input_choice(prompt, valid):
     while True:
         v = input(prompt).strip()
@@ -604,9 +3167,16 @@ def input_float(prompt):
             print("Precio inválido. Ejemplo: 19.99")
 
 def agregar_etiqueta():
-    global next_tag_id
-
-    snapshot, resp, rid = poll_tags(timeout_s=3.0)
+    # Solo hacen falta unas cuantas VACÍAS: no esperar a toda la flota
+    polled = admin_poll(
+        timeout_s=3.0,
+        match=lambda cid, r: r.get("status") == "EMPTY" and not held_for_bulk(cid),
+        limit=MAX_EMPTY_LISTED,
+    )
+    if polled is None:
+        print("⚠️ Servidor ocupado con escaneos; inténtalo de nuevo en unos segundos.")
+        return
+    snapshot, resp, rid = polled
 
     clear()
     print(c("=== ALTA / CONFIGURAR ETIQUETA (solo VACÍAS) ===", "36"))
@@ -619,8 +3189,8 @@ def agregar_etiqueta():
     # Filtrar solo las EMPTY (en tiempo real)
     empty = []
     for cid, info in snapshot:
-        if cid in resp and resp[cid]["status"] == "EMPTY":
-            a = info["addr"]
+        if cid in resp and resp[cid]["status"] == "EMPTY" and not held_for_bulk(cid):
+            a = info.addr
             empty.append([str(cid), f"{a[0]}:{a[1]}", c("VACÍA", "33")])
 
     if not empty:
@@ -643,9 +3213,8 @@ def agregar_etiqueta():
             break
         print("Ese CID no está en la lista de VACÍAS.")
 
-    temporada = input_choice("Temporada (Invierno/Verano): ", {"Invierno", "Verano"})
-    tipo = input_choice("Tipo (Gorra/Camiseta/Pantalones/Calcetines): ",
-                        {"Gorra", "Camiseta", "Pantalones", "Calcetines"})
+    temporada = input_choice(f"Temporada ({'/'.join(TEMPORADAS)}): ", set(TEMPORADAS))
+    tipo = input_choice(f"Tipo ({'/'.join(TIPOS)}): ", set(TIPOS))
     # ubicacion = input_choice("Ubicación inicial (almacén/tienda): ", {"almacén", "tienda"})
     precio = input_float("Precio (float): ")
 
@@ -654,38 +3223,29 @@ def agregar_etiqueta():
     print(f"RID: {rid}   Hora: {now_ts()}\n")
     print("Acerque su etiqueta NFC al lector de CAJA para asignar UID...\n")
 
-    nfc_cid, nfc_conn, _ = get_nfc_reader("BOX")
-    if not nfc_conn:
+    nfc_cid, nfc, _ = get_nfc_reader("BOX")
+    if not nfc:
         print("❌ No hay lector NFC BOX conectado.")
         return
 
-    read_rid = str(int(time.time() * 1000))
+    read_rid = new_rid()
+    uid_timeout = 10.0  # 10s para acercar el tag
+    w = correlator.register(("UID", read_rid), uid_timeout + WAITER_GRACE_S)
 
-    # limpiar posible residuo
-    with uid_cv:
-        uid_responses.pop(read_rid, None)
-
-    # pedir UID
     try:
-        send_line(nfc_conn, f"READUID {read_rid}")
-    except Exception as e:
-        print("❌ No se pudo pedir UID al lector BOX:", e)
-        return
+        # pedir UID
+        try:
+            send_line(nfc, f"READUID {read_rid}")
+        except Exception as e:
+            print("❌ No se pudo pedir UID al lector BOX:", e)
+            return
 
-    # esperar UID
-    uid_hex = None
-    deadline = time.time() + 10.0  # 10s para acercar el tag
-    with uid_cv:
-        while True:
-            got = uid_responses.get(read_rid)
-            if got:
-                uid_hex = got["uid"]
-                uid_responses.pop(read_rid, None)
-                break
-            remaining = deadline - time.time()
-            if remaining <= 0:
-                break
-            uid_cv.wait(timeout=remaining)
+        # esperar UID
+        uid_hex = None
+        if w.wait_until(lambda w: bool(w.responses), uid_timeout):
+            uid_hex = next(iter(w.responses.values()))
+    finally:
+        correlator.unregister(w)
 
     if not uid_hex:
         print("⚠️ No se detectó UID a tiempo.")
@@ -693,122 +3253,512 @@ def agregar_etiqueta():
 
     print(f"✅ UID capturado: {uid_hex}\n")
 
-    with next_id_lock:
-        tag_id = next_tag_id
-        next_tag_id += 1
-
-    tag = {
-        "ID": tag_id,
-        "Temporada": temporada,
-        "Tipo": tipo,
-        "Ubicacion": "Almacén", # ubicacion
-        "Precio": precio,
-        "UID": uid_hex
-    }
+    tag_id = tag_ids.allocate()
 
-    with clients_lock:
-        if cid not in clients:
-            print("Esa etiqueta se ha desconectado justo ahora.")
-            return
-        conn = clients[cid]["conn"]
+    tag = TagRecord(tag_id, temporada, tipo, "Almacén", precio, uid_hex)  # ubicacion
 
-    payload = json.dumps(tag, ensure_ascii=False)
-    cmd = f"SET {payload}"
+    sess = clients.get(cid)
+    if not sess:
+        print("Esa etiqueta se ha desconectado justo ahora.")
+        return
 
+    ack_timeout = 2.0  # timeout 2s (ajústalo)
+    w = correlator.register(("ACK", cid), ack_timeout + WAITER_GRACE_S)
     try:
-        send_line(conn, cmd)
+        send_set(cid, sess, tag)
 
         # Esperar ACK del mismo CID y mismo ID
-        ok = False
-        deadline = time.time() + 2.0  # timeout 2s (ajústalo)
-
-        with ack_cv:
-            while True:
-                got = ack_responses.get(cid, None)
-                if got == tag_id:
-                    ok = True
-                    break
-
-                remaining = deadline - time.time()
-                if remaining <= 0:
-                    break
-
-                ack_cv.wait(timeout=remaining)
+        ok = w.wait_until(lambda w: w.responses.get(cid) == tag_id, ack_timeout)
 
         if ok:
-            with clients_lock:
-                if cid in clients:
-                    clients[cid]["configured"] = True
-                    clients[cid]["tag_data"] = tag
+            sess.configured = True
+            sess.tag_data = tag
             print(f"\n✅ Etiqueta confirmada por ACK: CID [{cid}] -> ID={tag_id}")
         else:
             print(f"\n⚠️ SET enviado pero NO llegó ACK a tiempo (CID [{cid}] -> ID={tag_id})")
 
     except Exception as e:
         print("\n❌ No se pudo enviar al cliente:", e)
+    finally:
+        correlator.unregister(w)
+
+
+# ------------------ Menú: alta masiva ------------------
+
+BULK_UID_TIMEOUT_S = 30.0   # sin tarjeta en este tiempo => se da por acabada la lectura
+BULK_ACK_TIMEOUT_S = 2.0
+BULK_SET_RETRIES = 3        # envíos del SET a una misma etiqueta antes de cambiar de etiqueta
+BULK_TAG_SWITCHES = 2       # etiquetas de reserva que se prueban por prenda
+BULK_MAX_INFLIGHT = 64      # SETs sin ACK a la vez; por encima se deja de pedir UIDs
+BULK_SPARE_TAGS = 16        # VACÍAS extra reservadas para reintentar en otra etiqueta
+BULK_POLL_TIMEOUT_S = 5.0
+
+
+def read_bulk_spec(filename: str):
+    """
+    CSV con columnas Temporada, Tipo, Precio y opcionalmente Cantidad.
+    Devuelve ([(temporada, tipo, precio)] expandido por Cantidad, [errores]).
+    """
+    items, errors = [], []
+    temporadas = {t.casefold(): t for t in TEMPORADAS}
+    tipos = {t.casefold(): t for t in TIPOS}
+    with open(filename, "r", newline="", encoding="utf-8-sig") as f:
+        reader = csv.DictReader(f)
+        for n, row in enumerate(reader, start=2):
+            row = {(k or "").strip().casefold(): (v or "").strip() for k, v in row.items()}
+            temporada = temporadas.get(row.get("temporada", "").casefold())
+            tipo = tipos.get(row.get("tipo", "").casefold())
+            try:
+                precio = float(row.get("precio", "").replace(",", "."))
+                cantidad = int(row.get("cantidad") or 1)
+            except ValueError:
+                precio = cantidad = None
+            if temporada is None or tipo is None or precio is None or cantidad is None or cantidad < 1:
+                errors.append(f"línea {n}: {row}")
+                continue
+            items.extend([(temporada, tipo, precio)] * cantidad)
+    return items, errors
+
+
+def reserve_empty_tags(count: int):
+    """Un único poll que para en cuanto hay `count` VACÍAS libres; las aparta en reserved_tags."""
+    polled = admin_poll(
+        timeout_s=BULK_POLL_TIMEOUT_S,
+        match=lambda cid, r: r.get("status") == "EMPTY" and not held_for_bulk(cid),
+        limit=count,
+    )
+    if polled is None:
+        return None
+    _, resp, _ = polled
+    with tags_lock:
+        free = [cid for cid, r in resp.items()
+                if r["status"] == "EMPTY" and not held_for_bulk(cid) and cid not in pending_sets]
+        free = sorted(free)[:count]
+        reserved_tags.update(free)
+    return free
+
+
+class BulkProvisioner:
+    """
+    Alta en serie: las VACÍAS se reservan con un solo poll, los UIDs llegan
+    del lector BOX uno tras otro (un READUID nuevo en cuanto llega el
+    anterior) y cada UID se configura con un SET sin esperar su ACK. Los
+    ACKs se comprueban entre lectura y lectura; sin ACK se reenvía, y tras
+    BULK_SET_RETRIES envíos la prenda pasa a una etiqueta de reserva.
+
+    La etiqueta abandonada queda en cuarentena (quarantined_tags) hasta que se
+    desconecte: su SET deja de estar pendiente y sus PONG DATA no se indexan
+    ni la sondea el reconciliador. Si aplicó el SET y solo se perdieron los
+    ACKs, ni un ACK tardío ni un PONG le pueden quitar el UID a la de reserva
+    que sí lo confirmó.
+    """
+
+    def __init__(self, items, tags, nfc):
+        self.pending = deque(enumerate(items))  # (nº de prenda, (temporada, tipo, precio))
+        self.free = deque(tags)
+        self.nfc = nfc
+        self.inflight = {}  # cid -> dict(n, tag, waiter, deadline, sends, abandoned)
+        self.results = {}   # nº de prenda -> (estado, cid, TagRecord | None, detalle)
+        self.seen_uids = set()
+        self.quarantined = []  # cids abandonados por no confirmar (pueden llevar el SET)
+        self.total = len(items)
+
+    def run(self):
+        uid_w = None
+        uid_deadline = 0.0
+        try:
+            while self.pending or self.inflight:
+                self._check_acks()
+
+                if uid_w is None and self.pending and self.free and len(self.inflight) < BULK_MAX_INFLIGHT:
+                    uid_w = correlator.register(("UID", new_rid()), BULK_UID_TIMEOUT_S + WAITER_GRACE_S)
+                    uid_deadline = time.time() + BULK_UID_TIMEOUT_S
+                    try:
+                        send_line(self.nfc, f"READUID {uid_w.key[1]}")
+                    except Exception as e:
+                        print(f"❌ Lector BOX no disponible: {e}")
+                        break
+                elif uid_w is None and self.pending and not self.free and not self.inflight:
+                    break  # no quedan etiquetas ni reintentos posibles
+
+                if uid_w is None:
+                    time.sleep(0.05)
+                    continue
+
+                if uid_w.wait_until(lambda w: bool(w.responses), 0.1):
+                    uid_hex = next(iter(uid_w.responses.values()))
+                    correlator.unregister(uid_w)
+                    uid_w = None
+                    self._on_uid(uid_hex)
+                elif time.time() >= uid_deadline:
+                    correlator.unregister(uid_w)
+                    uid_w = None
+                    print(f"⌛ Sin tarjetas en {BULK_UID_TIMEOUT_S:.0f}s: fin de la lectura.")
+                    while self.inflight:
+                        self._check_acks()
+                        time.sleep(0.05)
+                    break
+        finally:
+            if uid_w is not None:
+                correlator.unregister(uid_w)
+            for f in self.inflight.values():
+                correlator.unregister(f["waiter"])
+            with tags_lock:
+                reserved_tags.difference_update(self.free)
+                reserved_tags.difference_update(self.inflight)
+                for _, cid, _, _ in self.results.values():
+                    reserved_tags.discard(cid)
+
+        for n, _ in self.pending:
+            self.results[n] = ("SIN UID" if self.free else "SIN ETIQUETA", None, None, "")
+        return self.results
+
+    def _on_uid(self, uid_hex: str):
+        if uid_hex in self.seen_uids or lookup_uid(uid_hex)[0] is not None:
+            print(f"⚠️ UID {uid_hex} ya asignado: se ignora, acerque la siguiente tarjeta.")
+            metrics.inc("bulk.uid_dup")
+            return
+        self.seen_uids.add(uid_hex)
+
+        n, (temporada, tipo, precio) = self.pending.popleft()
+        tag_id = tag_ids.allocate()
+        tag = TagRecord(tag_id, temporada, tipo, "Almacén", precio, uid_hex)
+        print(f"[{len(self.seen_uids)}/{self.total}] UID {uid_hex} -> ID={tag_id} {tipo} {temporada} {precio:.2f}")
+        self._send(n, tag, abandoned=())
+
+    def _send(self, n: int, tag: TagRecord, abandoned):
+        while self.free:
+            cid = self.free.popleft()
+            sess = clients.get(cid)
+            if sess is None:
+                continue  # desconectada desde la reserva
+            w = correlator.register(("ACK", cid), BULK_ACK_TIMEOUT_S + WAITER_GRACE_S)
+            try:
+                send_set(cid, sess, tag)
+            except Exception:
+                correlator.unregister(w)
+                continue
+            metrics.inc("bulk.sets")
+            self.inflight[cid] = {"n": n, "tag": tag, "waiter": w, "sends": 1, "abandoned": abandoned,
+                                  "deadline": time.time() + BULK_ACK_TIMEOUT_S}
+            return
+        self.results[n] = ("SIN ETIQUETA", None, tag,
+                           "no quedan VACÍAS de reserva" + _abandoned_note(abandoned))
+
+    def _check_acks(self):
+        now = time.time()
+        for cid, f in list(self.inflight.items()):
+            tag, w = f["tag"], f["waiter"]
+            if w.responses.get(cid) == tag.id:
+                correlator.unregister(w)
+                del self.inflight[cid]
+                sess = clients.get(cid)
+                if sess:
+                    sess.configured = True
+                    sess.tag_data = tag
+                self.results[f["n"]] = ("OK", cid, tag, f"{f['sends']} envío(s)" + _abandoned_note(f["abandoned"]))
+                metrics.inc("bulk.ok")
+                continue
+            if now < f["deadline"]:
+                continue
+
+            sess = clients.get(cid)
+            if sess is not None and f["sends"] < BULK_SET_RETRIES:
+                # Reenvío a la misma etiqueta
+                f["sends"] += 1
+                f["deadline"] = now + BULK_ACK_TIMEOUT_S
+                metrics.inc("bulk.retries")
+                try:
+                    send_set(cid, sess, tag)
+                except Exception:
+                    pass
+                continue
+
+            # Etiqueta que no confirma
+            correlator.unregister(w)
+            del self.inflight[cid]
+            print(f"⚠️ CID [{cid}] sin ACK para ID={tag.id}.")
+            if len(f["abandoned"]) >= BULK_TAG_SWITCHES or not self.free:
+                # Sin más etiquetas que probar: si el ACK llega tarde, que se indexe
+                with tags_lock:
+                    reserved_tags.discard(cid)
+                self.results[f["n"]] = ("SIN ACK", cid, tag,
+                                        f"{len(f['abandoned']) + 1} etiqueta(s) probadas"
+                                        + _abandoned_note(f["abandoned"]))
+                metrics.inc("bulk.failed")
+            else:
+                # La prenda pasa a una de reserva; esta queda en cuarentena
+                quarantine_tag(cid)
+                self.quarantined.append(cid)
+                metrics.inc("bulk.quarantined")
+                self._send(f["n"], tag, (*f["abandoned"], cid))
+
+
+def _abandoned_note(abandoned) -> str:
+    if not abandoned:
+        return ""
+    return "; en cuarentena: " + ", ".join(f"CID {cid}" for cid in abandoned)
+
+
+def write_bulk_report(items, results) -> str:
+    filename = f"alta_masiva_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+    with open(filename, "w", newline="", encoding="utf-8") as f:
+        w = csv.writer(f)
+        w.writerow(["n", "temporada", "tipo", "precio", "estado", "cid", "id", "uid", "detalle"])
+        for n, (temporada, tipo, precio) in enumerate(items):
+            estado, cid, tag, detalle = results.get(n, ("SIN UID", None, None, ""))
+            w.writerow([n + 1, temporada, tipo, f"{precio:.2f}", estado,
+                        "" if cid is None else cid,
+                        tag.id if tag else "", tag.uid if tag else "", detalle])
+    return filename
+
+
+def alta_masiva():
+    filename = input("CSV con Temporada,Tipo,Precio[,Cantidad]: ").strip()
+    if not filename:
+        return
+    try:
+        items, errors = read_bulk_spec(filename)
+    except OSError as e:
+        print(f"❌ No se pudo leer {filename}: {e}")
+        return
+    for err in errors[:10]:
+        print(f"⚠️ Fila inválida, {err}")
+    if len(errors) > 10:
+        print(f"⚠️ ... y {len(errors) - 10} filas inválidas más")
+    if not items:
+        print("No hay prendas que dar de alta.")
+        return
+
+    _, nfc, _ = get_nfc_reader("BOX")
+    if not nfc:
+        print("❌ No hay lector NFC BOX conectado.")
+        return
+
+    print(f"Buscando {len(items)} etiquetas VACÍAS (+{BULK_SPARE_TAGS} de reserva)...")
+    tags = reserve_empty_tags(len(items) + BULK_SPARE_TAGS)
+    if tags is None:
+        print("⚠️ Servidor ocupado con escaneos; inténtalo de nuevo en unos segundos.")
+        return
+    if not tags:
+        print("No hay etiquetas VACÍAS ahora mismo (según PING).")
+        return
+    if len(tags) < len(items):
+        print(f"⚠️ Solo hay {len(tags)} VACÍAS: el resto de prendas quedará sin etiqueta.")
+
+    clear()
+    print(c("=== ALTA MASIVA ===", "36"))
+    print(f"{len(items)} prendas, {len(tags)} etiquetas reservadas. Hora: {now_ts()}")
+    print("Acerque las tarjetas NFC al lector de CAJA, una tras otra...\n")
+
+    t0 = time.time()
+    prov = BulkProvisioner(items, tags, nfc)
+    results = prov.run()
+
+    counts = {}
+    for estado, *_ in results.values():
+        counts[estado] = counts.get(estado, 0) + 1
+    print(c(f"\n=== RESULTADO ({time.time() - t0:.0f}s) ===", "36"))
+    print(_table([[k, str(v)] for k, v in sorted(counts.items())], ["ESTADO", "PRENDAS"]))
+
+    failed = [(n, r) for n, r in sorted(results.items()) if r[0] != "OK"]
+    if failed:
+        rows = [[str(n + 1), *map(str, items[n]), estado, "-" if cid is None else str(cid),
+                 str(tag.id) if tag else "-", detalle]
+                for n, (estado, cid, tag, detalle) in failed[:20]]
+        print(_table(rows, ["Nº", "TEMP", "TIPO", "PRECIO", "ESTADO", "CID", "ID", "DETALLE"]))
+        if len(failed) > 20:
+            print(f"... y {len(failed) - 20} más")
+    if prov.quarantined:
+        print(f"⚠️ Etiquetas en cuarentena (sin ACK, pueden llevar un SET; no se ofrecen "
+              f"para altas hasta que se reconecten): {', '.join(map(str, prov.quarantined))}")
+    print(f"Informe completo: {write_bulk_report(items, results)}")
+
+
+# ------------------ Menú: ver stock (caché) ------------------
 
+STOCK_MAX_STALENESS_S = 30.0  # sugerencia del menú para re-sondear
 
 
-# ------------------ Menú: ver stock (PING) ------------------
+def _fmt_age(seconds: float) -> str:
+    if seconds < 60:
+        return f"{seconds:.0f}s"
+    if seconds < 3600:
+        return f"{seconds / 60:.0f}m"
+    return f"{seconds / 3600:.1f}h"
 
-def ver_stock_ping(timeout_s=3.0):
-    snapshot, resp, rid = poll_tags(timeout_s=timeout_s)
+
+def stale_cids(max_age_s: float, now: float):
+    """Etiquetas conectadas sin datos en caché o con datos más viejos que max_age_s."""
+    out = []
+    for cid, info in clients.snapshot():
+        if info.role == "NFC" or cid in quarantined_tags:
+            continue
+        entry = tag_index.get(cid)
+        if entry is None or now - entry["ts"] > max_age_s:
+            out.append(cid)
+    return out
+
+
+def ver_stock(max_age_s=None, timeout_s=3.0):
+    """
+    Pinta el stock desde la caché (tag_index) sin esperar a nadie. Con
+    max_age_s, antes se re-sondean solo las entradas más viejas que eso;
+    el resto de la flota no recibe ningún PING.
+    """
+    refreshed = unanswered = ()
+    if max_age_s is not None:
+        stale = stale_cids(max_age_s, time.time())
+        if stale:
+            polled = admin_poll(timeout_s=timeout_s, cids=stale)
+            if polled is None:
+                print("⚠️ Servidor ocupado con escaneos; se muestra la caché sin refrescar.")
+            else:
+                _, resp, _ = polled
+                refreshed = stale
+                unanswered = set(stale) - set(resp)
+
+    snapshot = clients.snapshot()
     if not snapshot:
         print("No hay etiquetas conectadas.")
         return
 
-    headers = ["CID", "IP:PUERTO", "ESTADO", "ID", "TEMP", "TIPO", "UBIC", "UID", "PRECIO"]
+    headers = ["CID", "IP:PUERTO", "ESTADO", "ID", "TEMP", "TIPO", "UBIC", "UID", "PRECIO", "EDAD"]
     rows = []
+    now = time.time()
 
-    for cid, info in snapshot:
-        a = info["addr"]
+    for cid, info in sorted(snapshot, key=lambda x: x[0]):
+        a = info.addr
         ipport = f"{a[0]}:{a[1]}"
 
-        with clients_lock:
-            role = clients.get(cid, {}).get("role", "TAG")
-            nfc_role = clients.get(cid, {}).get("nfc_role", "")
-        
-        if role == "NFC":
-            rows.append([str(cid), ipport, c("NFC", "36"), "-", "-", "-", c(nfc_role, "36"), "-"])
+        if info.role == "NFC":
+            rows.append([str(cid), ipport, c("NFC", "36"), "-", "-", "-", c(info.nfc_role or "", "36")])
             continue
 
+        if cid in quarantined_tags:
+            rows.append([str(cid), ipport, c("CUARENTENA", "35")])
+            continue
 
-
-        if cid not in resp:
-            rows.append([str(cid), ipport, c("NO RESP", "31"), "-", "-", "-", "-", "-"])
+        entry = tag_index.get(cid)
+        if entry is None:
+            rows.append([str(cid), ipport, c("NO RESP" if cid in unanswered else "SIN DATOS", "31")])
             continue
 
-        status = resp[cid]["status"]
+        d = entry["tag"]
+        age = now - entry["ts"]
+        edad = _fmt_age(age)
+        if max_age_s is not None and age > max_age_s:
+            edad = c(edad, "33")
 
-        if status == "EMPTY":
-            rows.append([str(cid), ipport, c("VACÍA", "33"), "-", "-", "-", "-", "-"])
-        elif status == "DATA":
-            data_json = resp[cid]["data"] or "{}"
-            try:
-                d = json.loads(data_json)
-                rows.append([
-                    str(cid),
-                    ipport,
-                    c("OK", "32"),
-                    str(d.get("ID", "")),
-                    str(d.get("Temporada", "")),
-                    str(d.get("Tipo", "")),
-                    #str(d.get("Ubicacion", "")),
-                    color_ubicacion(str(d.get("Ubicacion", ""))),
-                    str(d.get("UID","")),
-                    f'{float(d.get("Precio", 0.0)):.2f}'
-                ])
-            except:
-                rows.append([str(cid), ipport, c("MAL JSON", "31"), "-", "-", "-", "-", "-"])
+        if cid in unanswered:
+            estado = c("NO RESP", "31")
+        elif d is None:
+            estado = c("VACÍA", "33")
+        else:
+            estado = c("OK", "32")
+
+        if d is None:
+            rows.append([str(cid), ipport, estado, "-", "-", "-", "-", "-", "-", edad])
         else:
-            rows.append([str(cid), ipport, c(status, "35"), "-", "-", "-", "-", "-"])
+            rows.append([
+                str(cid),
+                ipport,
+                estado,
+                "-" if d.id is None else str(d.id),
+                d.temporada,
+                d.tipo,
+                color_ubicacion(d.ubicacion),
+                d.uid,
+                f"{d.precio:.2f}",
+                edad,
+            ])
 
     clear()
-    print(c("=== STOCK EN VIVO (PING A TODAS LAS ETIQUETAS) ===", "36"))
-    print(f"RID: {rid}   Timeout: {timeout_s:.1f}s   Hora: {now_ts()}\n")
+    print(c("=== STOCK (CACHÉ DE PONG / SET / MOVE / SOLD) ===", "36"))
+    info = f"Hora: {now_ts()}"
+    if max_age_s is not None:
+        info += f"   Re-sondeadas: {len(refreshed)} (más de {max_age_s:.0f}s), sin respuesta: {len(unanswered)}"
+    print(info + "\n")
     print(_table(rows, headers))
 
 
+def menu_stock():
+    ver_stock()
+    while True:
+        v = input(f"\nRe-sondear las entradas con más de N segundos (p. ej. {STOCK_MAX_STALENESS_S:.0f}; "
+                  f"0 = todas; Enter = volver): ").strip().replace(",", ".")
+        if not v:
+            return
+        try:
+            max_age_s = float(v)
+        except ValueError:
+            print("Introduce un número de segundos.")
+            continue
+        ver_stock(max_age_s=max_age_s)
+
+
+def _input_facet(label: str, field: str):
+    with tags_lock:
+        values = stock_index.values(field)
+    opciones = ", ".join(f"{v} ({n})" for v, n in values) or "sin datos"
+    v = input(f"{label} [{opciones}] (Enter = todos): ").strip()
+    return v or None
+
+
+def _input_price(label: str):
+    while True:
+        v = input(f"{label} (Enter = sin límite): ").strip().replace(",", ".")
+        if not v:
+            return None
+        try:
+            return float(v)
+        except ValueError:
+            print("Precio inválido. Ejemplo: 19.99")
+
+
+def consultar_stock():
+    """Filtros sobre los índices de stock, paginado: no manda ni un PING."""
+    filters = {
+        "tipo": _input_facet("Tipo", "tipo"),
+        "temporada": _input_facet("Temporada", "temporada"),
+        "ubicacion": _input_facet("Ubicación", "ubicacion"),
+        "precio_min": _input_price("Precio mínimo"),
+        "precio_max": _input_price("Precio máximo"),
+    }
+    desc = ", ".join(f"{k}={v}" for k, v in filters.items() if v is not None) or "sin filtros"
+
+    page = 1
+    while True:
+        t0 = time.perf_counter()
+        res = query_stock(page=page, **filters)
+        us = (time.perf_counter() - t0) * 1e6
+        page = res["page"]
+
+        now = time.time()
+        rows = [[str(cid), "-" if d.id is None else str(d.id), d.temporada, d.tipo, color_ubicacion(d.ubicacion),
+                 d.uid, f"{d.precio:.2f}", _fmt_age(now - ts)]
+                for cid, d, ts in res["rows"]]
+
+        clear()
+        print(c("=== CONSULTA DE STOCK (ÍNDICES EN MEMORIA) ===", "36"))
+        print(f"Filtro: {desc}")
+        print(f"{res['total']} etiquetas, página {page}/{res['pages']} ({us:.0f} µs)\n")
+        if rows:
+            print(_table(rows, ["CID", "ID", "TEMP", "TIPO", "UBIC", "UID", "PRECIO", "EDAD"]))
+        else:
+            print("Ninguna etiqueta cumple el filtro.")
+
+        v = input("\nn = siguiente, p = anterior, número = ir a página, Enter = volver: ").strip().lower()
+        if not v:
+            return
+        if v == "n":
+            page += 1
+        elif v == "p":
+            page -= 1
+        elif v.isdigit():
+            page = int(v)
+
+
 # ------------------ Menú: consultar CSV ------------------
 
 def consultar_csv():
@@ -817,6 +3767,7 @@ def consultar_csv():
         print("1) Ver movimientos.csv")
         print("2) Ver ventas.csv")
         print("3) Resumen de ganancias (ventas)")
+        print("4) Buscar en el histórico (filtros, SQLite)")
         print("0) Volver")
         op = input("Opción: ").strip()
 
@@ -841,17 +3792,27 @@ def consultar_csv():
                 print(_table(table_rows, headers))
 
         elif op == "3":
-            headers, rows = read_last_rows(VEN_CSV, limit=100000)
-            total = 0.0
-            for r in rows:
-                try:
-                    total += float(str(r.get("precio", "0")).replace(",", "."))
-                except:
-                    pass
+            csv_writer.flush()
+            summary = sales_summary.snapshot()
             clear()
             print(c("=== RESUMEN DE GANANCIAS ===", "36"))
-            print(f"Ventas registradas: {len(rows)}")
-            print(f"Total (€): {total:.2f}")
+            print(f"Ventas registradas: {summary['count']}")
+            print(f"Total (€): {summary['total']:.2f}")
+
+            for key, title, last in (("tipo", "POR TIPO", None),
+                                     ("temporada", "POR TEMPORADA", None),
+                                     ("dia", "POR DÍA (últimos 7)", 7),
+                                     ("ip", "POR LECTOR (IP)", None)):
+                items = sorted(summary["by"][key].items())
+                if last:
+                    items = items[-last:]
+                if items:
+                    print(f"\n{title}")
+                    print(_table([[k, str(n), f"{t:.2f}"] for k, (n, t) in items],
+                                 [key.upper(), "VENTAS", "TOTAL (€)"]))
+
+        elif op == "4":
+            buscar_historico()
 
         elif op == "0":
             return
@@ -859,23 +3820,121 @@ def consultar_csv():
             print("Opción no válida.")
 
 
+def buscar_historico():
+    if event_store is None:
+        print("El histórico indexado no está activo (arranca el servidor con --sqlite).")
+        return
+
+    print("\nDeja en blanco los filtros que no quieras usar.")
+    evento = input("Evento (MOVE/SOLD): ").strip().upper()
+    tag_id = input("ID etiqueta: ").strip()
+    uid = input("UID (los CSV anteriores a la columna uid no lo guardan): ").strip().upper()
+    tipo = input("Tipo (Gorra/Camiseta/Pantalones/Calcetines): ").strip()
+    temporada = input("Temporada (Invierno/Verano): ").strip()
+    desde = input("Desde ubicación (Almacén/Tienda): ").strip()
+    hacia = input("Hacia ubicación (Almacén/Tienda): ").strip()
+    ts_from = input("Desde fecha (YYYY-MM-DD): ").strip()
+    ts_to = input("Hasta fecha, sin incluir (YYYY-MM-DD): ").strip()
+
+    csv_writer.flush()
+    try:
+        headers, rows = event_store.query(
+            evento=evento or None,
+            tag_id=_to_int(tag_id) if tag_id else None,
+            uid=uid or None,
+            tipo=tipo or None,
+            temporada=temporada or None,
+            desde=desde or None,
+            hacia=hacia or None,
+            ts_from=ts_from or None,
+            ts_to=ts_to or None,
+            limit=50,
+        )
+    except sqlite3.Error as e:
+        print("❌ Error consultando el histórico:", e)
+        return
+
+    clear()
+    print(c("=== HISTÓRICO FILTRADO (máx. 50, más recientes primero) ===", "36"))
+    if not rows:
+        print("Sin resultados.")
+        return
+    print(_table([["" if v is None else str(v) for v in r] for r in rows], headers))
+
+
+# ------------------ Menú: métricas ------------------
+
+def ver_metricas():
+    snap = metrics.snapshot()
+    clear()
+    print(c("=== MÉTRICAS ===", "36"))
+    print(f"Uptime: {snap['uptime_s']:.0f}s   Hora: {now_ts()}\n")
+
+    print(_table([[k, str(v)] for k, v in snap["gauges"].items()], ["GAUGE", "VALOR"]))
+
+    if snap["rates"]:
+        print()
+        print(_table([[k, f"{r['1s']:.0f}", f"{r['10s']:.1f}", f"{r['60s']:.1f}"]
+                      for k, r in snap["rates"].items()],
+                     ["TASA", "/s (1s)", "/s (10s)", "/s (60s)"]))
+
+    lat_rows = [[k, str(h["count"]), f"{h.get('p50_ms', 0)}", f"{h.get('p90_ms', 0)}",
+                 f"{h.get('p99_ms', 0)}", f"{h.get('max_ms', 0)}"]
+                for k, h in snap["latency"].items()]
+    if lat_rows:
+        print()
+        print(_table(lat_rows, ["LATENCIA", "N", "p50 ms", "p90 ms", "p99 ms", "max ms"]))
+
+    if snap["counters"]:
+        print()
+        print(_table([[k, str(v)] for k, v in snap["counters"].items()], ["CONTADOR", "VALOR"]))
+
+
+def register_gauges():
+    metrics.gauge("clients", lambda: len(clients))
+    metrics.gauge("clients.slow", lambda: sum(1 for _, s_ in clients.snapshot() if s_.slow))
+    metrics.gauge("tags.indexed", lambda: len(uid_index))
+    metrics.gauge("tags.cached", lambda: len(tag_index))
+    metrics.gauge("tags.with_data", lambda: len(stock_index))
+    metrics.gauge("tags.parked", lambda: len(registry))
+    metrics.gauge("tags.rebound", lambda: registry.rebound)
+    metrics.gauge("tags.next_id", tag_ids.peek)
+    metrics.gauge("waiters", lambda: len(correlator))
+    metrics.gauge("scan.queue", scan_executor.pending)
+    metrics.gauge("csv.queue", csv_writer.queued)
+    metrics.gauge("liveness.probes", lambda: liveness.probes)
+    metrics.gauge("liveness.evicted", lambda: liveness.evicted)
+    metrics.gauge("recon.rate", lambda: round(reconciler.rate, 1))
+    metrics.gauge("recon.rate_limit", lambda: round(reconciler.rate_limit, 1))
+    metrics.gauge("recon.loss", lambda: round(reconciler.loss, 3))
+
+
 # ------------------ Menú principal ------------------
 
 def menu_loop():
     while True:
         print("\n--- MENÚ SERVIDOR ---")
         print("1) Agregar una etiqueta (usa PING y muestra solo VACÍAS)")
-        print("2) Ver stock (PING a todas las etiquetas)")
+        print("2) Ver stock (caché, re-sondeo de lo antiguo)")
         print("3) Consultar registros (CSV)")
+        print("4) Métricas (latencias y throughput)")
+        print("5) Consultar stock (filtros y páginas)")
+        print("6) Alta masiva desde CSV")
         print("0) Salir")
         op = input("Opción: ").strip()
 
         if op == "1":
             agregar_etiqueta()
         elif op == "2":
-            ver_stock_ping()
+            menu_stock()
         elif op == "3":
             consultar_csv()
+        elif op == "4":
+            ver_metricas()
+        elif op == "5":
+            consultar_stock()
+        elif op == "6":
+            alta_masiva()
         elif op == "0":
             print("Saliendo.")
             break
@@ -883,10 +3942,109 @@ def menu_loop():
             print("Opción no válida.")
 
 
+def shutdown():
+    registry.save()
+    csv_writer.close()
+    sales_summary.save()
+    if journal is not None:
+        journal.close()
+    stop_logging()
+
+
 def main():
-    t = threading.Thread(target=acceptor_thread, daemon=True)
+    global event_store, journal, PORT, RECV_SIZE, MAX_LINE_BYTES, RECON_MAX_RATE
+
+    parser = argparse.ArgumentParser(description="Servidor TCP de etiquetas ZaraStock")
+    parser.add_argument("--sqlite", nargs="?", const=EVENT_DB, metavar="DB",
+                        help=f"guardar también los eventos en SQLite (por defecto {EVENT_DB})")
+    parser.add_argument("--port", type=int, default=PORT, metavar="PUERTO",
+                        help=f"puerto TCP de etiquetas y lectores (por defecto {PORT})")
+    parser.add_argument("--recv-size", type=int, default=RECV_SIZE, metavar="BYTES",
+                        help=f"tamaño de cada lectura de socket (por defecto {RECV_SIZE})")
+    parser.add_argument("--max-line", type=int, default=MAX_LINE_BYTES, metavar="BYTES",
+                        help=f"longitud máxima de línea antes de desconectar (por defecto {MAX_LINE_BYTES})")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, metavar="PUERTO",
+                        help=f"endpoint HTTP local de métricas, 0 para desactivarlo (por defecto {METRICS_PORT})")
+    parser.add_argument("--reconcile", type=float, default=RECON_MAX_STALENESS_S, metavar="SEG",
+                        help="edad máxima de la caché de stock: re-sondeo repartido en segundo plano, "
+                             f"0 para desactivarlo (por defecto {RECON_MAX_STALENESS_S:.0f})")
+    parser.add_argument("--reconcile-max-rate", type=float, default=RECON_MAX_RATE, metavar="PINGS/S",
+                        help=f"techo de PINGs/s de la reconciliación (por defecto {RECON_MAX_RATE:.0f})")
+    parser.add_argument("--registro", default=REGISTRY_JSON, metavar="FICHERO",
+                        help=f"foto del registro de etiquetas para arrancar en caliente "
+                             f"(por defecto {REGISTRY_JSON}; '' para desactivarla)")
+    parser.add_argument("--sin-menu", action="store_true",
+                        help="arrancar sin menú interactivo (benchmarks, servicio); se para con Ctrl+C o SIGTERM")
+    parser.add_argument("--capture", metavar="FICHERO",
+                        help="grabar todas las líneas de entrada y salida en un diario JSONL")
+    parser.add_argument("--replay", metavar="FICHERO",
+                        help="reproducir un diario sin red (usar en un directorio aparte: escribe CSV)")
+    parser.add_argument("--replay-speed", type=float, default=1.0, metavar="X",
+                        help="velocidad de --replay: 1 = tiempo real, 0 = lo más rápido posible")
+    parser.add_argument("--log-file", default=LOG_FILE, metavar="FICHERO",
+                        help=f"log rotativo (por defecto {LOG_FILE}; '' para desactivarlo)")
+    parser.add_argument("--log-level", default=LOG_FILE_LEVEL, type=str.upper,
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help=f"nivel del fichero de log (por defecto {LOG_FILE_LEVEL})")
+    parser.add_argument("--console-level", default=LOG_CONSOLE_LEVEL, type=str.upper,
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help=f"nivel de la consola (por defecto {LOG_CONSOLE_LEVEL})")
+    parser.add_argument("--log-sample", action="append", default=[], metavar="CMD=N",
+                        help="registrar 1 de cada N líneas de ese comando (p. ej. PONG=1000; 1 = todas)")
+    args = parser.parse_args()
+
+    for spec in args.log_sample:
+        cmd, _, every = spec.partition("=")
+        try:
+            LOG_SAMPLE[cmd.strip().upper()] = max(1, int(every))
+        except ValueError:
+            parser.error(f"--log-sample: se esperaba CMD=N, no '{spec}'")
+    setup_logging(args.log_file, args.log_level, args.console_level)
+
+    PORT = args.port
+    RECV_SIZE = args.recv_size
+    MAX_LINE_BYTES = args.max_line
+    RECON_MAX_RATE = max(RECON_MIN_RATE, args.reconcile_max_rate)
+    reconciler.max_staleness_s = args.reconcile
+    reconciler.rate_limit = RECON_MAX_RATE
+
+    sales_summary.attach(csv_writer)
+    if args.sqlite:
+        event_store = SqliteEventStore(args.sqlite)
+        event_store.attach(csv_writer)
+    atexit.register(shutdown)
+    register_gauges()
+    if args.replay:
+        replay_journal(args.replay, args.replay_speed)
+        return
+    registry.path = args.registro
+    tag_ids.load(floor=registry.load() + 1)
+    registry.start()
+    if args.capture:
+        journal = TrafficJournal(args.capture)
+    if args.metrics_port:
+        start_metrics_server(METRICS_HOST, args.metrics_port)
+    liveness.start()
+    t = threading.Thread(target=event_loop_thread, daemon=True)
     t.start()
-    menu_loop()
+    reconciler.start()
+    if not args.sin_menu:
+        menu_loop()
+        return
+
+    # SIGTERM -> salida normal para que atexit vacíe los CSV
+    signal.signal(signal.SIGTERM, _exit_on_signal)
+    try:
+        while t.is_alive():
+            t.join(1.0)
+    except KeyboardInterrupt:
+        pass
+
+
+def _exit_on_signal(signum, frame):
+    # Un segundo SIGTERM no debe cortar el vaciado de CSV y log en atexit
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise SystemExit(0)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,78 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server_tcp  # noqa: E402
+
+
+class FakeConn:
+    """Socket de mentira: cada recv_into entrega el siguiente trozo del guion."""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv_into(self, view):
+        data = self.chunks.pop(0)
+        view[:len(data)] = data
+        return len(data)
+
+
+class FakeSession:
+    def __init__(self, chunks):
+        self.cid = 7
+        self.addr = ("127.0.0.1", 5000)
+        self.conn = FakeConn(chunks)
+        self.buffer = bytearray()
+        self.last_seen = 0.0
+
+
+@pytest.fixture
+def loop(monkeypatch):
+    seen = {"msgs": [], "closed": []}
+    monkeypatch.setattr(server_tcp, "process_message", lambda cid, msg: seen["msgs"].append((cid, msg)))
+    monkeypatch.setattr(server_tcp, "close_client", lambda cid: seen["closed"].append(cid))
+    monkeypatch.setattr(server_tcp, "journal", None)
+    return seen
+
+
+def _feed(sess, times, size=64 * 1024):
+    view = memoryview(bytearray(size))
+    for _ in range(times):
+        server_tcp._read_client(sess, view)
+
+
+def test_burst_of_lines_in_one_recv(loop):
+    sess = FakeSession([b"PONG 1 EMPTY\nACK ID=3\r\n\nMOVE x\n"])
+    _feed(sess, 1)
+    assert loop["msgs"] == [(7, "PONG 1 EMPTY"), (7, "ACK ID=3"), (7, "MOVE x")]
+    assert sess.buffer == b""
+    assert loop["closed"] == []
+
+
+def test_line_split_across_recvs(loop):
+    sess = FakeSession([b"PONG 1 DA", b"TA {\"ID\": 1}", b"\nACK", b" ID=1\nPI"])
+    _feed(sess, 4)
+    assert loop["msgs"] == [(7, 'PONG 1 DATA {"ID": 1}'), (7, "ACK ID=1")]
+    assert sess.buffer == b"PI"
+    assert loop["closed"] == []
+
+
+def test_oversized_complete_line_disconnects(loop):
+    big = b"X" * (server_tcp.MAX_LINE_BYTES + 1)
+    sess = FakeSession([b"ACK ID=1\n" + big + b"\nACK ID=2\n"])
+    _feed(sess, 1)
+    assert loop["msgs"] == [(7, "ACK ID=1")]
+    assert loop["closed"] == [7]
+
+
+def test_oversized_unterminated_line_disconnects(loop):
+    half = b"X" * (server_tcp.MAX_LINE_BYTES // 2 + 1)
+    sess = FakeSession([b"ACK ID=1\n" + half, half])
+    _feed(sess, 1)
+    assert loop["closed"] == []
+    _feed(sess, 1)
+    assert loop["msgs"] == [(7, "ACK ID=1")]
+    assert loop["closed"] == [7]
@@ -0,0 +1,57 @@
+import csv
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server_tcp  # noqa: E402
+
+HEADERS = ["timestamp", "ip", "id", "temporada", "tipo", "from", "to", "precio"]
+
+
+def _full_parse(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return [dict(r) for r in csv.DictReader(f)]
+
+
+def _write(path, rows):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        w = csv.writer(f)
+        w.writerow(HEADERS)
+        w.writerows(rows)
+
+
+def test_block_starting_inside_quoted_field_that_looks_like_a_record(tmp_path, monkeypatch):
+    # La cola del campo multilínea es por sí sola una línea válida de 8 campos
+    path = str(tmp_path / "mov.csv")
+    fake = ",".join(["q"] * 8)
+    _write(path, [["a", "b", "c", "d", "e", "f", "g", "x\n" + fake], list("12345678")])
+    with open(path, "rb") as f:
+        data = f.read()
+    # El bloque empieza justo en el salto de línea de dentro de las comillas
+    monkeypatch.setattr(server_tcp, "TAIL_BLOCK_BYTES", len(data) - data.index(b"x\n") - 1)
+
+    headers, rows = server_tcp.read_last_rows(path, limit=2)
+
+    assert headers == HEADERS
+    assert rows == _full_parse(path)[-2:]
+
+
+def test_matches_full_parse_on_random_files(tmp_path, monkeypatch):
+    rnd = random.Random(7)
+    pieces = ["q", ",", "\n", "\r\n", '"', "Tienda", "x y"]
+    path = str(tmp_path / "mov.csv")
+
+    for block in (8, 16, 64):
+        monkeypatch.setattr(server_tcp, "TAIL_BLOCK_BYTES", block)
+        for _ in range(300):
+            rows = [["".join(rnd.choice(pieces) for _ in range(rnd.randint(0, 3)))
+                     for _ in HEADERS] for _ in range(rnd.randint(1, 12))]
+            _write(path, rows)
+            limit = rnd.randint(1, 8)
+
+            headers, got = server_tcp.read_last_rows(path, limit=limit)
+
+            assert headers == HEADERS
+            assert got == _full_parse(path)[-limit:]